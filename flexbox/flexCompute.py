@@ -469,9 +469,8 @@ def transform_to_geometry(R, T, geom):
     Transforms a rotationa matrix and translation vector. 
     """    
     # Translate to flex geometry:
-    geom = geom.copy()
-    geom['vol_rot'] = transforms3d.euler.mat2euler(R.T, axes = 'sxyz')
-    geom['vol_tra'] = numpy.array(geom['vol_tra']) - numpy.dot(T, R.T)[[0, 2, 1]] * geom['det_pixel']
+    geom = flexData.copy_geometry(geom, vol_rot = transforms3d.euler.mat2euler(R.T, axes = 'sxyz'), 
+                                  vol_tra = numpy.array(geom['vol_tra']) - numpy.dot(T, R.T)[[0, 2, 1]] * geom['det_pixel'])
     
     return geom
     
@@ -823,9 +822,7 @@ def _modifier_l2cost_(projections, geometry, subsample, value, key = 'axs_hrz',
     '''
     Cost function based on L2 norm of the first derivative of the volume. Computation of the first derivative is done by FDK with pre-initialized reconstruction filter.
     '''
-    geometry_ = geometry.copy()
-    
-    geometry_[key] = value
+    geometry_ = flexData.copy_geometry(geometry, **{key: value})
 
     vol = flexProject.sample_FDK(projections, geometry_, subsample)
 
@@ -881,7 +878,7 @@ def optimize_rotation_center(projections, geometry, guess = None, subscale = 1,
         
             guess = geometry['axs_hrz']
         
-    img_pix = geometry['det_pixel'] / ((geometry['src2obj'] + geometry['det2obj']) / geometry['src2obj'])
+    img_pix = geometry['det_pixel'] / flexData.magnification(geometry)
     
     print('The initial guess for the rotation axis shift is %0.3f mm' % guess)
     
@@ -913,7 +910,9 @@ def process_flex(path, options = {'bin':1, 'memmap': None}):
     
     Args:
         path:  path to the flexray data
-        options: dictionary of options, such as bin (binning), memmap (use memmap to save RAM)
+        options: dictionary of options, such as bin (binning), memmap (use memmap to save RAM), workers (number of reading threads),
+                 average (bin by averaging pixels and angles instead of decimating), 
+                 dtype (float16 or uint16 to save RAM) and bounds (range of values stored as integers)
         
     Return:
         proj: min-log projections
@@ -927,48 +926,32 @@ def process_flex(path, options = {'bin':1, 'memmap': None}):
     skip = options.get('skip')
     if skip is None:
         skip = bins
+        
+    workers = options.get('workers')
+    if workers is None:
+        workers = 1
+        
+    average = bool(options.get('average'))
+    
+    dtype = options.get('dtype')
+    if dtype is None:
+        dtype = 'float32'
     
     # Read:    
     print('Reading...')
     
-    dark = flexData.read_raw(path, 'di', sample = [bins, bins])
-    flat = flexData.read_raw(path, 'io', sample = [bins, bins])    
+    dark = flexData.read_raw(path, 'di', sample = [bins, bins], workers = workers, average = average)
+    flat = flexData.read_raw(path, 'io', sample = [bins, bins], workers = workers, average = average)    
     
+    # Flat-field correction and minus-log are applied on the fly, projections are written in ASTRA order:
     index = []
-    proj = flexData.read_raw(path, 'scan_', skip = skip, sample = [bins, bins], memmap = memmap, index = index)
+    proj = flexData.read_projections(path, 'scan_', dark, flat, skip = skip, sample = [bins, bins], dtype = dtype, bounds = options.get('bounds'), 
+                                     memmap = memmap, index = index, workers = workers, average = average)
 
     meta = flexData.read_log(path, 'flexray', bins = bins)   
-            
-    # Prepro:
-    print('Processing...')
-    proj -= dark
-    proj /= (flat.mean(0) - dark)
-        
-    numpy.log(proj, out = proj)
-    proj *= -1
-    
-    # Fix nans and infs after log:
-    proj[~numpy.isfinite(proj)] = 0
-    
-    proj = flexData.raw2astra(proj)    
     
     # Here we will also check whether all files were read and if not - modify thetas accordingly:
-    index = numpy.array(index)
-    index //= skip
-    
-    if (index[-1] + 1) != index.size:
-        print(index.size)
-        print(index[-1] + 1)
-        print('Seemes like some files were corrupted or missing. We will try to correct thetas accordingly.')
-        
-        thetas = numpy.linspace(meta['geometry']['theta_min'], meta['geometry']['theta_max'], index[-1]+1)
-        thetas = thetas[index]
-        
-        meta['geometry']['_thetas_'] = thetas
-        
-        import pylab
-        pylab.plot(thetas, thetas ,'*')
-        pylab.title('Thetas')
+    meta['geometry'] = flexData.set_thetas(meta['geometry'], index, skip)
     
     return proj, meta
 
@@ -16,13 +16,43 @@ We can now read/write:
 
 import numpy
 import os
+import copy
+import collections.abc
 import re
+import stat
+import time
+import threading
 import astra 
 import transforms3d
 import transforms3d.euler
 
 from . import flexUtil
 
+''' * Globals * '''
+
+# Name of the sidecar file that keeps the list of files in a scan directory:
+manifest_name = '.flexbox_manifest.json'
+
+# Default name of the SQLite catalog of scans created by build_catalog:
+catalog_name = '.flexbox_catalog.sqlite'
+
+# Catalog columns that can be used in queries and the meta records they are taken from:
+_catalog_columns_ = {'voltage': 'settings', 'power': 'settings', 'exposure': 'settings', 'averages': 'settings', 
+                     'mode': 'settings', 'filter': 'settings', 'binning': 'geometry', 'theta_count': 'geometry', 
+                     'theta_min': 'geometry', 'theta_max': 'geometry', 'img_pixel': 'geometry', 'det_pixel': 'geometry', 
+                     'src2obj': 'geometry', 'det2obj': 'geometry', 'name': 'description', 'comments': 'description', 
+                     'date': 'description'}
+
+# Projection geometries computed by astra_proj_geom:
+_proj_geom_cache_ = {}
+
+# Manifests that were already loaded by this process:
+_manifests_ = {}
+_manifest_lock_ = threading.RLock()
+
+# Locks of the manifests of single directories (directories are updated in parallel):
+_manifest_locks_ = {}
+
 ''' * Methods * '''
 
 def read_flexray(path):
@@ -48,7 +78,7 @@ def read_flexray(path):
     
     return proj, flat, dark, meta
         
-def read_raw(path, name, skip = 1, sample = [1, 1], x_roi = [], y_roi = [], dtype = 'float32', memmap = None, index = None):
+def read_raw(path, name, skip = 1, sample = [1, 1], x_roi = [], y_roi = [], dtype = 'float32', memmap = None, index = None, workers = 1, average = False, layout = 'raw', frames = None):
     """
     Read tiff files stack and return numpy array.
     
@@ -59,77 +89,119 @@ def read_raw(path, name, skip = 1, sample = [1, 1], x_roi = [], y_roi = [], dtyp
         sample (int): sampling factor in x/y direction
         x_roi ([x0, x1]): horizontal range
         y_roi ([y0, y1]): vertical range
-        dtype (str or numpy.dtype): data type to return
+        dtype (str or numpy.dtype): data type to return (e.g. float16 or uint16 to save RAM)
         memmap (str): if provided, return a disk mapped array to save RAM
         index (array): if provided, will output an index array corresponding to succefully read files.
+        workers (int): number of threads used to decode files concurrently
+        average (bool): if True, bin the data by averaging blocks of sample[0] x sample[1] pixels and groups of skip files instead of decimating
+        layout (str): 'raw' - [index, row, col] or 'astra' - every image is written directly into a C-contiguous 
+                      [row, index, col] array with flipped rows (same as raw2astra, but without a strided view)
+        frames (list): if provided, read only the files with these indexes (skip and average are ignored), see read_angles
         
     Returns:
-        numpy.array : 3D array with the first dimension representing the image index
+        numpy.array : 3D array with the first (raw) or the second (astra) dimension representing the image index
         
     """  
-        
-    # Retrieve files, sorted by name
-    files = _get_files_sorted_(path, name)
-    
-    # Create index of existing files:
-    indx = numpy.array([int(re.findall(r'\d+', f)[-1]) for f in files])
+    if layout not in ['raw', 'astra']: raise ValueError('Unknown layout: ' + str(layout))
     
-    if indx.size > 1:
-        indx //= (indx[1] - indx[0])
-        indx -= indx.min()
-        
-        #print([ii for ii in numpy.where(indx % skip == 0)])
-        reduc = numpy.where(indx % skip == 0)[0]
+    astra = (layout == 'astra')
         
-        files = [files[ii] for ii in reduc]
-        indx = indx[indx % skip == 0]
+    # Retrieve files that we need, sorted by name and their index:
+    files, indx = _select_files_(path, name, skip, average, frames)
     
     if len(files) == 0: raise IOError('Files not found:', os.path.join(path, name))
     
-    # Read the first file:
-    image = _read_tiff_(files[0], sample, x_roi, y_roi)
-    sz = numpy.shape(image)
+    # Read the first file that is not corrupted:
+    sz = _probe_shape_(files, sample, x_roi, y_roi, average)
     
     file_n = len(indx)
+    shape = (sz[0], file_n, sz[1]) if astra else (file_n, sz[0], sz[1])
         
     # Create a mapped array if needed:
     if memmap:
-        data = numpy.memmap(memmap, dtype='float32', mode='w+', shape = (file_n, sz[0], sz[1]))
+        data = numpy.memmap(memmap, dtype = dtype, mode='w+', shape = shape)
         
     else:    
-        data = numpy.zeros((file_n, sz[0], sz[1]), dtype = numpy.float32)
+        data = numpy.zeros(shape, dtype = dtype)
     
     # Read all files:  
-    good = []
+    good = _read_files_(files, data, sample, x_roi, y_roi, workers, average, astra = astra)
+
+    # Get rid of the corrupted data:
+    if len(good) != file_n:
+        print('WARNING! %u files are CORRUPTED!'%(file_n - len(good)))
+        
+        indx = indx[good]
+        data = _compact_(data, good, axis = 1 if astra else 0)
+
+    # Output index:
+    if index is not None:
+        index[:] = indx
+    
+    print('%u files were loaded.' % file_n)
+
+    return data    
+
+def read_projections(path, name, dark, flat, skip = 1, sample = [1, 1], x_roi = [], y_roi = [], dtype = 'float32', bounds = None, memmap = None, index = None, workers = 1, average = False, frames = None):
+    """
+    Read tiff files stack, apply flat-field correction and minus-log to every frame while it is read and 
+    write it directly into an ASTRA-compatible C-contiguous array [row, index, col] (rows are flipped like in raw2astra).
     
-    for k, ii in enumerate(indx):
-        #print(ii)
-        #print(files[ii])
-        filename = files[k]
+    Args:
+        path (str): path to the files location
+        name (str): common part of the files name
+        dark (numpy.array): dark field images [index, row, col], will be averaged
+        flat (numpy.array): flat field images [index, row, col], will be averaged
+        skip, sample, x_roi, y_roi, workers, average, frames: see read_raw
+        dtype (str or numpy.dtype): storage type. Floats (float32, float16) are stored as is, 
+                                    integers (e.g. uint16) are stored scaled to bounds and returned as a ScaledArray
+        bounds (list): [min, max] of the values that can be stored in an integer dtype
+        memmap (str): if provided, return a disk mapped array to save RAM
+        index (array): if provided, will output an index array corresponding to succefully read files.
         
-        try:
-            a = _read_tiff_(filename, sample, x_roi, y_roi)
-            
-            # Summ RGB:    
-            if a.ndim > 2:
-                a = a.mean(2)
-         
-            #flexUtil.display_slice(a)    
-            data[k, :, :] = a
-            good.append(k)
+    Returns:
+        numpy.array : 3D array with the second dimension representing the image index
+    """
+    # Retrieve files that we need, sorted by name and their index:
+    files, indx = _select_files_(path, name, skip, average, frames)
+    
+    if len(files) == 0: raise IOError('Files not found:', os.path.join(path, name))
+    
+    # Average references:
+    dark = numpy.float32(dark.mean(0) if dark.ndim == 3 else dark)
+    flat = numpy.float32(flat.mean(0) if flat.ndim == 3 else flat)
+    
+    sz = dark.shape
+    file_n = len(indx)
         
-        except:
-            pass
-            #a = numpy.zeros(data.shape[1:], dtype = numpy.float32)
-            
-        flexUtil.progress_bar((k+1) / (indx.size))
-
+    dtype = numpy.dtype(dtype)
+    
+    if (dtype.kind in 'iu') & (bounds is None): raise ValueError('Bounds are needed to store projections as integers.')
+        
+    # Create a mapped array if needed:
+    if memmap:
+        data = numpy.memmap(memmap, dtype = dtype, mode='w+', shape = (sz[0], file_n, sz[1]))
+        
+    else:    
+        data = numpy.zeros((sz[0], file_n, sz[1]), dtype = dtype)
+        
+    # Integers store scaled values:
+    if dtype.kind in 'iu':
+        data = ScaledArray(data, bounds)
+        
+    # Read and process all files:  
+    good = _read_files_(files, data, sample, x_roi, y_roi, workers, average, dark, flat, astra = True)
+    
     # Get rid of the corrupted data:
     if len(good) != file_n:
         print('WARNING! %u files are CORRUPTED!'%(file_n - len(good)))
         
         indx = indx[good]
-        data = data[good]
+        
+        if isinstance(data, ScaledArray):
+            data = ScaledArray(_compact_(data.data, good, axis = 1), [data.offset, data.offset + data.scale * data._range_])
+        else:
+            data = _compact_(data, good, axis = 1)
 
     # Output index:
     if index is not None:
@@ -139,7 +211,331 @@ def read_raw(path, name, skip = 1, sample = [1, 1], x_roi = [], y_roi = [], dtyp
 
     return data    
 
-def write_raw(path, name, data, dim = 1, skip = 1, dtype = None):
+def read_angles(path, name, geometry = None, angles = None, theta_range = None, stride = 1, dark = None, flat = None, **kwargs):
+    """
+    Read only the frames at the selected angles. Frame numbers are computed from the angles assuming that 
+    the frames are evenly spaced between theta_min and theta_max (like in astra_proj_geom), so only the selected files are read.
+    
+    Args:
+        path (str): path to the files location
+        name (str): common part of the files name
+        geometry (dict): geometry record with theta_min, theta_max and theta_count (if theta_count is unknown, 
+                         the number of files is used). If None, it is read from the log file
+        angles (list): angles in degrees - the nearest frames are read (in the increasing order of frames)
+        theta_range ([min, max]): range of angles in degrees
+        stride (int): read every so many frames of the range
+        dark, flat (numpy.array): if provided, projections are flat-field corrected and returned in the ASTRA layout (see read_projections)
+        kwargs: passed to read_raw or read_projections (sample, memmap, workers, layout...)
+        
+    Returns:
+        numpy.array : data
+        geometry : a copy of the geometry record with the angles of the frames that were read (_thetas_)
+    """
+    if geometry is None:
+        geometry = read_log(path, 'flexray')['geometry']
+        
+    # Frames of the whole scan:
+    files, indx = _get_files_indexed_(path, name)
+    
+    if len(files) == 0: raise IOError('Files not found:', os.path.join(path, name))
+    
+    # Number of frames of the scan: the log knows it even if the last frames are missing:
+    count = int(geometry.get('theta_count') or 0)
+    
+    if count < 1: 
+        count = int(indx[-1]) + 1
+    
+    theta_min = geometry['theta_min']
+    step = (geometry['theta_max'] - theta_min) / max(1, count - 1)
+    
+    # Angle to frame number:
+    position = lambda x: (numpy.asarray(x, dtype = 'float64') - theta_min) / step if step else numpy.zeros(numpy.shape(x))
+    
+    if angles is not None:
+        frames = numpy.unique(numpy.clip(numpy.round(position(angles)), 0, count - 1).astype('int64'))[::stride]
+        
+    else:
+        first, last = 0, count - 1
+        
+        if theta_range is not None:
+            a, b = sorted(position(theta_range))
+            first, last = max(first, int(numpy.ceil(a - 1e-6))), min(last, int(numpy.floor(b + 1e-6)))
+            
+        frames = numpy.arange(first, last + 1, stride)
+        
+    if frames.size == 0: raise ValueError('No frames found in the selected range of angles.')
+        
+    index = []
+    
+    if (dark is not None) & (flat is not None):
+        data = read_projections(path, name, dark, flat, frames = frames, index = index, **kwargs)
+    else:
+        data = read_raw(path, name, frames = frames, index = index, **kwargs)
+        
+    # Angles of the frames that were read successfully:
+    thetas = theta_min + numpy.array(index, dtype = 'float64') * step
+    
+    return data, copy_geometry(geometry, _thetas_ = thetas)
+
+class ScaledArray:
+    """
+    Array of floats stored as scaled integers (e.g. uint16) to save memory. Values in the range of [min, max] bounds 
+    are mapped to the full range of the integer type. Indexing returns float32 arrays, assignment converts floats to integers.
+    """
+    
+    def __init__(self, data, bounds):
+        """
+        Wrap an integer array (or memmap) that stores values within bounds = [min, max].
+        """
+        self.data = data
+        
+        info = numpy.iinfo(data.dtype)
+        
+        self._min_ = info.min
+        self._range_ = float(info.max) - float(info.min)
+        
+        self.offset = float(bounds[0])
+        self.scale = (float(bounds[1]) - float(bounds[0])) / self._range_
+        
+        # Inverse scale used on assignment (all values map to bounds[0] if the range is empty):
+        self._inverse_ = 1 / self.scale if self.scale != 0 else 0
+        
+        # Data type of the values that are returned:
+        self.dtype = numpy.dtype('float32')
+        
+    @property
+    def shape(self):
+        return self.data.shape
+    
+    @property
+    def ndim(self):
+        return self.data.ndim
+    
+    @property
+    def size(self):
+        return self.data.size
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def __array__(self, dtype = None, copy = None):
+        
+        array = self[...]
+        
+        if dtype is not None:
+            array = array.astype(dtype, copy = False)
+            
+        return array
+    
+    def copy(self):
+        """
+        Convert the whole array to float32.
+        """
+        return self[...]
+    
+    def __getitem__(self, key):
+        
+        block = numpy.array(self.data[key], dtype = 'float32')
+        
+        block -= self._min_
+        block *= self.scale
+        block += self.offset
+        
+        return block
+    
+    def __setitem__(self, key, value):
+        
+        value = numpy.array(value, dtype = 'float32')
+        
+        value -= self.offset
+        value *= self._inverse_
+        
+        # Values outside of bounds are clipped:
+        numpy.clip(value, 0, self._range_, out = value)
+        value += self._min_
+        
+        self.data[key] = numpy.round(value)
+        
+def read_virtual(path, name, skip = 1, dtype = 'float32', dark = None, flat = None, index = None, workers = 1):
+    """
+    Index a stack of uncompressed tiff files without reading it. Returns a lazily-evaluated 3D array that reads 
+    projections or sinogram slabs from disk on demand.
+    
+    Args:
+        path (str): path to the files location
+        name (str): common part of the files name
+        skip (int): use every so many files
+        dtype (str or numpy.dtype): data type of the returned blocks
+        dark (numpy.array): if provided together with flat, blocks are flat-field corrected and minus-logged on access
+        flat (numpy.array): flat field, see dark
+        index (array): if provided, will output an index array corresponding to succefully indexed files.
+        workers (int): number of threads used to parse the file headers
+        
+    Returns:
+        TiffStack : 3D array-like object with the first dimension representing the image index
+    """
+    # Retrieve files, sorted by name and their index:
+    files, indx = _get_files_indexed_(path, name)
+    
+    if len(files) == 0: raise IOError('Files not found:', os.path.join(path, name))
+    
+    files = [f for f, ii in zip(files, indx) if ii % skip == 0]
+    indx = indx[indx % skip == 0]
+    
+    # Parse the layout of every file once:
+    def parse(file):
+        try:
+            return _tiff_layout_(file)
+        except:
+            return None
+        
+    if workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            layouts = list(pool.map(parse, files))
+    else:
+        layouts = [parse(f) for f in files]
+    
+    # Files that can't be parsed or have a different shape are considered corrupted:
+    shape = next((l['shape'] for l in layouts if l), None)
+    good = [k for k, l in enumerate(layouts) if l and (l['shape'] == shape)]
+    
+    if len(good) == 0: raise IOError('No readable files found:', os.path.join(path, name))
+    
+    if len(good) != len(files):
+        print('WARNING! %u files are CORRUPTED!'%(len(files) - len(good)))
+        
+    # Output index:
+    if index is not None:
+        index[:] = indx[good]
+        
+    print('%u files were indexed.' % len(good))
+    
+    return TiffStack([files[k] for k in good], [layouts[k] for k in good], dtype, dark, flat)
+    
+class TiffStack:
+    """
+    Lazily-evaluated stack of tiff files. Can be indexed like a numpy array (integers, slices and one index array per key): 
+    only the requested rows and columns are read from disk (uncompressed files are accessed through numpy.memmap) and converted to dtype.
+    Use raw2astra to get the ASTRA-compatible view of the stack.
+    """
+    
+    def __init__(self, files, layouts, dtype = 'float32', dark = None, flat = None, astra = False):
+        """
+        Initialize the stack with a list of files and their layouts (see _tiff_layout_).
+        """
+        self.files = files
+        self.layouts = layouts
+        self.dtype = numpy.dtype(dtype)
+        
+        # Flat-field correction uses average dark and flat images:
+        if (dark is not None) and (dark.ndim == 3): 
+            dark = dark.mean(0)
+            
+        if (flat is not None) and (flat.ndim == 3): 
+            flat = flat.mean(0)
+            
+        self.dark = dark
+        self.flat = flat
+        
+        # ASTRA view: [row, index, col] with flipped rows
+        self.astra = astra
+        
+    @property
+    def shape(self):
+        
+        height, width = self.layouts[0]['shape']
+        
+        if self.astra:
+            return (height, len(self.files), width)
+        else:
+            return (len(self.files), height, width)
+        
+    @property
+    def ndim(self):
+        return 3
+    
+    @property
+    def size(self):
+        return int(numpy.prod(self.shape))
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def __array__(self, dtype = None, copy = None):
+        
+        array = self[:, :, :]
+        
+        if dtype is not None:
+            array = array.astype(dtype, copy = False)
+            
+        return array
+    
+    def copy(self):
+        """
+        Read the whole stack into RAM.
+        """
+        return self[:, :, :]
+    
+    def __getitem__(self, key):
+        
+        key = _expand_key_(key, 3, 'TiffStack', advanced = 1)
+        
+        # Translate the key to the order of the files on disk:
+        if self.astra:
+            k_row, k_file, k_col = key
+            height = self.layouts[0]['shape'][0]
+            
+            # Rows are flipped in the ASTRA view:
+            k_row = numpy.arange(height - 1, -1, -1)[k_row]
+            
+        else:
+            k_file, k_row, k_col = key
+            
+        files = numpy.arange(len(self.files))[k_file]
+        
+        block = numpy.stack([self._read_(ii, k_row, k_col) for ii in numpy.atleast_1d(files)])
+        
+        # Swap [index, row, col] -> [row, index, col]:
+        axis = 0
+        
+        if self.astra & (numpy.ndim(k_row) > 0):
+            block = numpy.moveaxis(block, 0, 1)
+            axis = 1
+            
+        # Drop the file dimension if it was indexed by an integer: 
+        if numpy.ndim(files) == 0:
+            block = block.take(0, axis = axis)
+            
+        return block
+    
+    def _read_(self, ii, k_row, k_col):
+        """
+        Read a part of a single file.
+        """
+        layout = self.layouts[ii]
+        
+        if _strips_contiguous_(layout):
+            image = numpy.memmap(self.files[ii], dtype = layout['dtype'], mode = 'r', offset = int(layout['offsets'][0]), 
+                                 shape = layout['shape'] + ((layout['samples'],) if layout['samples'] > 1 else ()))
+        else:
+            image = _read_tiff_(self.files[ii])
+        
+        image = image[k_row, k_col]
+        
+        # Summ RGB:
+        if layout['samples'] > 1:
+            image = image.mean(-1)
+            
+        image = numpy.array(image, dtype = self.dtype)
+        
+        if (self.dark is not None) & (self.flat is not None):
+            _flatfield_(image, self.dark[k_row, k_col], self.flat[k_row, k_col])
+            
+        return image
+
+def write_raw(path, name, data, dim = 1, skip = 1, dtype = None, pyramid = None, bounds = None, workers = 1):
     """
     Write tiff stack.
     
@@ -150,6 +546,11 @@ def write_raw(path, name, data, dim = 1, skip = 1, dtype = None):
         dim (int): dimension along which array is separated into images
         skip (int): how many images to skip in between
         dtype (type): forse this data type       
+        pyramid (list): if provided, also write downsampled copies of the written stack (e.g. [2, 4, 8]) to subfolders x2, x4, x8. 
+                        Each level averages blocks of factor^3 voxels. Use read_pyramid to read them.
+        bounds (list or str): [min, max] used to cast data to dtype. If None, the exact range is computed in a separate pass over the data. 
+                              If 'auto', the range is estimated from robust quantiles of a subsample of the data.
+        workers (int): number of threads used to cast and write images concurrently
     """
     
     import imageio
@@ -163,16 +564,40 @@ def write_raw(path, name, data, dim = 1, skip = 1, dtype = None):
     # Write files stack:    
     file_num = int(numpy.ceil(data.shape[dim] / skip))
 
-    bounds = [data.min(), data.max()]
+    # Bounds are only needed if data is cast: 
+    if isinstance(bounds, str):
+        bounds = _bounds_(data, quantiles = [0.001, 0.999])
+        
+    elif (bounds is None) & (dtype is not None):
+        bounds = _bounds_(data, workers = workers)
     
-    for ii in range(file_num):
+    # Accumulators of the downsampled levels:
+    levels = [{'factor': int(f), 'sum': None, 'count': 0, 'index': 0} for f in (pyramid if pyramid else [])]
+    
+    for level in levels:
+        if not os.path.exists(os.path.join(path, 'x%u' % level['factor'])):
+            os.makedirs(os.path.join(path, 'x%u' % level['factor']))
+    
+    def slices():
+        
+        for ii in range(file_num):
+            
+            path_name = os.path.join(path, name + '_%06u.tiff'% (ii*skip))
+            
+            # Extract one slice from the big array (copy, so that the cast doesn't change the data)
+            sl = flexUtil.anyslice(data, ii * skip, dim)
+            img = numpy.array(data[sl])
+            
+            # Add the slice to the downsampled levels before it is cast:
+            for level in levels:
+                _pyramid_add_(level, img, os.path.join(path, 'x%u' % level['factor']), name, dtype, bounds)
+                
+            yield path_name, img
+            
+    def write_one(item):
         
-        path_name = os.path.join(path, name + '_%06u.tiff'% (ii*skip))
+        path_name, img = item
         
-        # Extract one slice from the big array
-        sl = flexUtil.anyslice(data, ii * skip, dim)
-        img = data[sl]
-          
         # Cast data to another type if needed
         if dtype is not None:
             img = cast2type(img, dtype, bounds)
@@ -180,8 +605,52 @@ def write_raw(path, name, data, dim = 1, skip = 1, dtype = None):
         # Write it!!!
         imageio.imwrite(path_name, img)
         
-        flexUtil.progress_bar((ii+1) / file_num)
+    # Slices are extracted in order in this thread, casting and writing is done by the workers:
+    _map_progress_(write_one, slices(), workers, file_num)
+        
+def read_pyramid(path, name, shape = None, **kwargs):
+    """
+    Read the coarsest level of a tiff stack written with write_raw(pyramid = ...) that is at least as big as the requested shape.
+    
+    Args:
+        path (str): path to the full resolution stack
+        name (str): common part of the files name
+        shape (list): minimal shape of the data [index, row, col]. If None, the coarsest level is read.
+        kwargs: passed to read_raw (memmap, workers, etc.)
+        
+    Returns:
+        numpy.array : 3D array with the first dimension representing the image index
+        int : downsampling factor of the level that was read
+    """
+    # Find all levels:
+    levels = {1: path}
+    
+    for folder in os.listdir(path):
+        if re.fullmatch(r'x\d+', folder) and os.path.isdir(os.path.join(path, folder)):
+            levels[int(folder[1:])] = os.path.join(path, folder)
+            
+    # Pick the coarsest level that is big enough:
+    for factor in sorted(levels.keys(), reverse = True):
+        
+        files = _get_files_sorted_(levels[factor], name)
         
+        if len(files) == 0: continue
+    
+        if shape is None:
+            break
+        
+        level_shape = (len(files),) + _frame_layout_(levels[factor], name)[0]
+        
+        if all(numpy.array(level_shape) >= numpy.array(shape)):
+            break
+        
+    else:
+        factor = 1
+        
+    print('Reading pyramid level x%u' % factor)
+            
+    return read_raw(levels[factor], name, **kwargs), factor
+
 def write_tiff(filename, image):
     """
     Write a single image.
@@ -195,67 +664,314 @@ def write_tiff(filename, image):
     
     imageio.imwrite(filename, image)
 
-def cast2type(array, dtype, bounds = None):
+def write_chunked(path, data, meta = None, chunks = [64, 64, 64], codec = 'zlib', shuffle = True, workers = 1):
     """
-    Cast from float to int or float to float rescaling values if needed.
-    """
-    # No? Yes? OK...
-    if array.dtype == dtype:
-        return array
+    Write a 3D array to a directory of compressed chunks with a TOML header. Chunks that contain only zeroes are not written.
     
-    # Make sue dtype is not a string:
-    dtype = numpy.dtype(dtype)
+    Args:
+        path (str): destination directory
+        data (numpy.array): data to write (can be a memmap)
+        meta (dict): meta data to keep in the header
+        chunks (list): shape of a single chunk
+        codec (str): compression - 'zlib', 'lzma', 'zstd' (needs zstandard package) or None
+        shuffle (bool): apply byte shuffling before compression (helps to compress floats)
+        workers (int): number of threads used to compress chunks concurrently
+    """
+    print('Writing chunked data...')
     
-    # If cast to float, simply cast:
-    if dtype.kind == 'f':
-        return numpy.array(array, dtype)
+    # Make path if does not exist:
+    if not os.path.exists(path):
+        os.makedirs(path)
+        
+    # Check the codec early:
+    _chunk_codec_(codec)
+        
+    header = {'shape': list(data.shape), 'dtype': numpy.dtype(data.dtype).str, 'chunks': list(chunks), 
+              'codec': str(codec), 'shuffle': shuffle}
     
-    # If to integer, rescale:
-    if bounds is None:
-        bounds = [numpy.amin(array), numpy.amax(array)]
+    array = ChunkedArray(path, header)
     
-    data_max = numpy.iinfo(dtype).max
+    def write_one(key):
+        # Each chunk is read from the source on its own to keep memory low:
+        array._write_chunk_(key, numpy.asarray(data[array._chunk_slice_(key)]))
     
-    array -= bounds[0]
-    array *= data_max / (bounds[1] - bounds[0])
+    keys = array._chunk_keys_()
     
-    array[array < 0] = 0
-    array[array > data_max] = data_max
+    _map_progress_(write_one, keys, workers)
     
-    array = numpy.array(array, dtype)    
+    # Header is written last so that a partially written array is not mistaken for a complete one:
+    write_meta(os.path.join(path, 'header.toml'), {'array': header, 'meta': meta if meta else {}})
     
-    return array          
-        
-def read_log(path, name, log_type = 'flexray', bins = 1):
+def read_chunked(path, workers = 1):
     """
-    Read the log file and return dictionaries with parameters of the scan.
+    Open a chunked array written by write_chunked. Data is read from disk only when the array is indexed.
     
     Args:
-        path (str): path to the files location
-        name (str): common part of the files name
-        log_type (bool): type of the log file
-        bins: forced binning in [y, x] direction
+        path (str): directory of the chunked array
+        workers (int): number of threads used to read and decompress chunks concurrently
         
-    Returns:    
-        geometry : src2obj, det2obj, det_pixel, thetas, det_hrz, det_vrt, det_mag, det_rot, src_hrz, src_vrt, src_mag, axs_hrz, vol_hrz, vol_tra 
-        settings : physical settings - voltage, current, exposure
-        description : lyrical description of the data
+    Returns:
+        ChunkedArray : 3D array-like object, use [...] to read a part of it, meta data is in the .meta attribute
     """
-    #print(path)
+    header = read_meta(os.path.join(path, 'header.toml'))
     
-    if log_type != 'flexray': raise ValueError('Non-flexray log files are not supported yet. File a complaint form to the support team.')
+    return ChunkedArray(path, header['array'], header.get('meta'), workers)
+
+class ChunkedArray:
+    """
+    Array stored as a directory of compressed chunks. Indexing with integers and slices reads only the chunks that are needed.
+    """
     
-    # Get dictionary to translate keywords:
-    dictionary = _get_flexray_keywords_()
+    def __init__(self, path, header, meta = None, workers = 1):
+        """
+        Initialize the array with its location and header (shape, dtype, chunks, codec, shuffle).
+        """
+        self.path = path
+        self.shape = tuple(int(x) for x in header['shape'])
+        self.dtype = numpy.dtype(header['dtype'])
+        self.chunks = tuple(int(x) for x in header['chunks'])
+        self.codec = None if header['codec'] == 'None' else header['codec']
+        self.shuffle = header['shuffle']
+        
+        self.meta = meta
+        self.workers = workers
+        
+    @property
+    def ndim(self):
+        return len(self.shape)
     
-    # Read recods from the file:
-    geometry, settings, description = _parse_keywords_(path, 'settings.txt', dictionary, separator = ':')
+    @property
+    def size(self):
+        return int(numpy.prod(self.shape))
     
-    # Check if all th relevant fields are there:
-    _sanity_check_(geometry)
+    def __len__(self):
+        return self.shape[0]
     
-    # Apply Flexray-specific corrections and restructure records:
-    geometry = _correct_flex_(geometry) 
+    def __array__(self, dtype = None, copy = None):
+        
+        array = self[:, :, :]
+        
+        if dtype is not None:
+            array = array.astype(dtype, copy = False)
+            
+        return array
+    
+    def copy(self):
+        """
+        Read the whole array into RAM.
+        """
+        return self[:, :, :]
+        
+    def __getitem__(self, key):
+        
+        key = _expand_key_(key, self.ndim, 'ChunkedArray')
+        
+        # For every dimension find the chunks that intersect with the request:
+        ranges = []
+        squeeze = []
+        
+        for dim, k in enumerate(key):
+            
+            if isinstance(k, slice):
+                start, stop, step = k.indices(self.shape[dim])
+                
+            elif isinstance(k, (int, numpy.integer)):
+                start = int(k) + self.shape[dim] if k < 0 else int(k)
+                
+                if (start < 0) | (start >= self.shape[dim]): raise IndexError('Index out of range:', k)
+                
+                stop, step = start + 1, 1
+                squeeze.append(dim)
+                
+            else:
+                raise IndexError('Only integers and slices are supported by ChunkedArray.')
+                
+            if step < 0: raise IndexError('Negative steps are not supported by ChunkedArray.')
+            
+            ranges.append(_chunk_ranges_(start, stop, step, self.chunks[dim]))
+        
+        out = numpy.zeros([sum(o.stop - o.start for c, o, l in r) for r in ranges], dtype = self.dtype)
+        
+        def read_one(ii):
+            c0, o0, l0 = ranges[0][ii[0]]
+            c1, o1, l1 = ranges[1][ii[1]]
+            c2, o2, l2 = ranges[2][ii[2]]
+            
+            chunk = self._read_chunk_((c0, c1, c2))
+            
+            if chunk is not None:
+                out[o0, o1, o2] = chunk[l0, l1, l2]
+        
+        # Each chunk writes into its own part of the output:
+        todo = numpy.ndindex(*[len(r) for r in ranges])
+        
+        if self.workers > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            
+            with ThreadPoolExecutor(max_workers = self.workers) as pool:
+                list(pool.map(read_one, todo))
+        else:
+            for ii in todo: read_one(ii)
+            
+        return out.squeeze(axis = tuple(squeeze)) if squeeze else out
+    
+    def _chunk_keys_(self):
+        """
+        Indexes of all chunks.
+        """
+        return list(numpy.ndindex(*[int(numpy.ceil(n / c)) for n, c in zip(self.shape, self.chunks)]))
+        
+    def _chunk_slice_(self, key):
+        """
+        Part of the array covered by a chunk.
+        """
+        return tuple(slice(k * c, min((k + 1) * c, n)) for k, c, n in zip(key, self.chunks, self.shape))
+    
+    def _chunk_file_(self, key):
+        
+        return os.path.join(self.path, 'chunk_%u_%u_%u' % tuple(key))
+    
+    def _read_chunk_(self, key):
+        """
+        Read and decompress a single chunk. Returns None if the chunk contains only zeroes.
+        """
+        file = self._chunk_file_(key)
+        
+        if not os.path.exists(file):
+            return None
+        
+        with open(file, 'rb') as f:
+            buffer = _chunk_codec_(self.codec)[1](f.read())
+            
+        shape = [sl.stop - sl.start for sl in self._chunk_slice_(key)]
+        
+        if self.shuffle:
+            # Undo the byte shuffling:
+            buffer = numpy.frombuffer(buffer, dtype = 'uint8').reshape(self.dtype.itemsize, -1).T.copy()
+            
+        return numpy.frombuffer(buffer, dtype = self.dtype).reshape(shape)
+    
+    def _write_chunk_(self, key, chunk):
+        """
+        Compress and write a single chunk. Chunks that contain only zeroes are not written.
+        """
+        file = self._chunk_file_(key)
+        
+        if not chunk.any():
+            if os.path.exists(file): os.remove(file)
+            return
+        
+        buffer = numpy.ascontiguousarray(chunk, dtype = self.dtype)
+        
+        if self.shuffle:
+            # Put the bytes with the same significance next to each other:
+            buffer = numpy.ascontiguousarray(buffer.view('uint8').reshape(-1, self.dtype.itemsize).T)
+            
+        with open(file, 'wb') as f:
+            f.write(_chunk_codec_(self.codec)[0](buffer.tobytes()))
+    
+def cast2type(array, dtype, bounds = None, memmap = None, workers = 1):
+    """
+    Cast from float to int or float to float rescaling values if needed. The input is not modified: 
+    the result is written to a new array (or memmap) slab by slab, so the input can be a memmap that doesn't fit in RAM.
+    
+    Args:
+        array: data to cast (array, memmap or array-like)
+        dtype: new data type
+        bounds (list or str): [min, max] that is mapped to the range of the integer type. If None, the exact range 
+                              is computed in a single pass. If 'auto', robust quantiles are estimated from a subsample.
+        memmap (str): if provided, the result is a disk mapped array
+        workers (int): number of threads (each works on its own slab)
+        
+    Returns:
+        cast array
+    """
+    # No? Yes? OK...
+    if (array.dtype == dtype) and not memmap:
+        return array
+    
+    # Make sue dtype is not a string:
+    dtype = numpy.dtype(dtype)
+    
+    if memmap:
+        result = numpy.memmap(memmap, dtype = dtype, mode = 'w+', shape = array.shape)
+    else:
+        result = numpy.zeros(array.shape, dtype = dtype)
+        
+    # If to integer, rescale:
+    if dtype.kind in 'iu':
+        
+        if isinstance(bounds, str):
+            bounds = _bounds_(array, quantiles = [0.001, 0.999])
+        
+        elif bounds is None:
+            bounds = _bounds_(array, workers = workers)
+    
+        data_max = numpy.iinfo(dtype).max
+        scale = data_max / (bounds[1] - bounds[0]) if bounds[1] != bounds[0] else 0
+        
+    # Slabs of about 64 MB:
+    step = max(1, int(2**24 // max(1, numpy.prod(array.shape[1:]))))
+    
+    def cast_slab(ii):
+        
+        key = slice(ii, ii + step)
+        
+        # If cast to float, simply cast:
+        if dtype.kind not in 'iu':
+            result[key] = array[key]
+            return
+            
+        slab = numpy.asarray(array[key])
+        slab = numpy.array(slab, dtype = numpy.result_type(slab.dtype, numpy.float32))
+        
+        slab -= bounds[0]
+        slab *= scale
+        
+        numpy.clip(slab, 0, data_max, out = slab)
+        
+        result[key] = slab
+        
+    starts = range(0, len(array), step)
+    
+    # Small arrays (like single images in write_raw) are cast right here:
+    if len(starts) > 1:
+        _map_progress_(cast_slab, starts, workers)
+    else:
+        for ii in starts: cast_slab(ii)
+    
+    return result
+        
+def read_log(path, name, log_type = 'flexray', bins = 1):
+    """
+    Read the log file and return dictionaries with parameters of the scan.
+    
+    Args:
+        path (str): path to the files location
+        name (str): common part of the files name
+        log_type (bool): type of the log file
+        bins: forced binning in [y, x] direction
+        
+    Returns:    
+        geometry : src2obj, det2obj, det_pixel, thetas, det_hrz, det_vrt, det_mag, det_rot, src_hrz, src_vrt, src_mag, axs_hrz, vol_hrz, vol_tra 
+        settings : physical settings - voltage, current, exposure
+        description : lyrical description of the data
+    """
+    #print(path)
+    
+    if log_type != 'flexray': raise ValueError('Non-flexray log files are not supported yet. File a complaint form to the support team.')
+    
+    # Get dictionary to translate keywords:
+    dictionary = _get_flexray_keywords_()
+    
+    # Read recods from the file:
+    geometry, settings, description = _parse_keywords_(path, 'settings.txt', dictionary, separator = ':')
+    
+    # Check if all th relevant fields are there:
+    _sanity_check_(geometry)
+    
+    # Apply Flexray-specific corrections and restructure records:
+    geometry = _correct_flex_(geometry) 
     
     # Make sure that records that were not found are set to zeroes:
     #for key in geometry.keys():
@@ -291,6 +1007,11 @@ def write_meta(filename, meta):
     if not os.path.exists(path):
         os.makedirs(path)
     
+    # Geometry records are saved as plain dictionaries:
+    if isinstance(meta.get('geometry'), Geometry):
+        meta = dict(meta)
+        meta['geometry'] = meta['geometry'].to_dict()
+    
     # Save TOML to a file:
     with open(filename, 'w') as f:
         toml.dump(meta, f)
@@ -323,9 +1044,279 @@ def read_meta(file_path):
     # Parse TOML string:
     return toml.load(file_path)
 
-def pad(array, dim, width, symmetric = False):
+def build_catalog(root, catalog = None, name = 'scan_', workers = 4, refresh = False):
+    """
+    Find all scan folders (folders with a settings.txt) under the root and index their metadata in an SQLite catalog.
+    Only folders that are new or changed since the last update are parsed. Folders that disappeared are removed.
+    
+    Args:
+        root (str): root folder of the archive
+        catalog (str): catalog file, default is root/.flexbox_catalog.sqlite
+        name (str): common part of the projection file names (used to count frames)
+        workers (int): number of threads that parse the log files
+        refresh (bool): parse all log files again
+        
+    Returns:
+        catalog (str): path to the catalog file
+    """
+    root = os.path.abspath(root)
+    
+    if catalog is None:
+        catalog = os.path.join(root, catalog_name)
+        
+    # Find scan folders:
+    paths = [dirpath for dirpath, dirnames, filenames in os.walk(root) if 'settings.txt' in filenames]
+    
+    update_catalog(catalog, paths, name = name, workers = workers, refresh = refresh)
+    
+    # Forget the folders that are gone:
+    import sqlite3
+    
+    with sqlite3.connect(catalog) as db:
+        known = [row[0] for row in db.execute('SELECT path FROM scans')]
+        gone = [(x,) for x in set(known).difference(paths) if (x + os.sep).startswith(root + os.sep)]
+        
+        db.executemany('DELETE FROM scans WHERE path = ?', gone)
+    
+    return catalog
+
+def update_catalog(catalog, paths, name = 'scan_', workers = 1, refresh = False):
     """
-    Pad an array along the given dimension.
+    Add scan folders to the catalog or update the ones that changed (log file or folder modification time).
+    
+    Args:
+        catalog (str): catalog file (created if needed)
+        paths (list): scan folders
+        name (str): common part of the projection file names (used to count frames)
+        workers (int): number of threads that parse the log files
+        refresh (bool): parse all log files again
+        
+    Returns:
+        count (int): number of records that were updated
+    """
+    import sqlite3
+    
+    paths = [os.path.abspath(x) for x in paths]
+    
+    db = sqlite3.connect(catalog)
+    
+    try:
+        columns = ''.join(', %s' % x for x in _catalog_columns_)
+        db.execute('CREATE TABLE IF NOT EXISTS scans (path TEXT PRIMARY KEY, log_mtime INTEGER, dir_mtime INTEGER, '
+                   'frames INTEGER, manifest TEXT, meta TEXT, error TEXT' + columns + ')')
+        
+        known = {row[0]: row[1:] for row in db.execute('SELECT path, log_mtime, dir_mtime FROM scans')}
+        
+        # Only parse the folders that changed:
+        stamps = {}
+        for path in paths:
+            try:
+                stamps[path] = (os.stat(os.path.join(path, 'settings.txt')).st_mtime_ns, os.stat(path).st_mtime_ns)
+            except OSError:
+                continue
+        
+        todo = [x for x in stamps if refresh or known.get(x) != stamps[x]]
+        
+        if not todo: return 0
+        
+        print('Updating the catalog:', len(todo), 'records')
+        
+        # Parse in parallel, write in this thread:
+        records = []
+        _map_progress_(lambda x: records.append(_catalog_record_(x, name, stamps[x])), todo, workers)
+        
+        fields = ['path', 'log_mtime', 'dir_mtime', 'frames', 'manifest', 'meta', 'error'] + list(_catalog_columns_)
+        
+        db.executemany('INSERT OR REPLACE INTO scans (%s) VALUES (%s)' % (', '.join(fields), ', '.join('?' * len(fields))), 
+                       [[record.get(x) for x in fields] for record in records])
+        db.commit()
+        
+    finally:
+        db.close()
+        
+    return len(todo)
+
+def query_catalog(catalog, where = None, params = (), paths = None, bins = 1, **conditions):
+    """
+    Find scans in the catalog. Conditions on the catalog columns (voltage, binning, theta_count...) are combined with AND.
+    
+    Args:
+        catalog (str): catalog file
+        where (str): extra SQL condition, e.g. 'voltage BETWEEN ? AND ?'
+        params (tuple): parameters of the SQL condition
+        paths (list): only return these folders
+        bins: forced binning in [y, x] direction (same as in read_log)
+        conditions: column = value, e.g. voltage = 90, binning = 2
+        
+    Returns:
+        metas (dict): meta records (see read_log) of the scans that match, indexed by folder
+    """
+    import sqlite3
+    import json
+    
+    clauses = ['error IS NULL']
+    values = []
+    
+    for key, value in conditions.items():
+        if key not in _catalog_columns_ and key not in ['frames', 'manifest']:
+            raise ValueError('Unknown catalog column: ' + key)
+            
+        clauses.append('%s = ?' % key)
+        values.append(value)
+        
+    if where:
+        clauses.append('(%s)' % where)
+        values.extend(params)
+        
+    if paths is not None:
+        paths = [os.path.abspath(x) for x in paths]
+        clauses.append('path IN (%s)' % ', '.join('?' * len(paths)))
+        values.extend(paths)
+        
+    with sqlite3.connect(catalog) as db:
+        rows = db.execute('SELECT path, meta FROM scans WHERE ' + ' AND '.join(clauses) + ' ORDER BY path', values).fetchall()
+    
+    metas = {}
+    for path, meta in rows:
+        meta = json.loads(meta)
+        
+        # Apply binning if needed:
+        meta['geometry']['det_pixel'] *= bins
+        meta['geometry']['img_pixel'] *= bins
+        
+        metas[path] = meta
+        
+    return metas
+
+class PaddedArray:
+    """
+    Padded and/or cropped view of an array (or memmap, TiffStack...) that doesn't copy the data. 
+    The view starts at offset (can be negative) of the data and has the given shape. Elements outside of the data are zeroes.
+    Zeroes are only created for the blocks that are extracted. Keys can have integers, slices and one index array. 
+    Use pad(..., virtual = True) to create a view: 
+    pad and crop of a view return a new view of the same data.
+    """
+    
+    def __init__(self, data, offset, shape):
+        """
+        Wrap the data. offset and shape are given per dimension.
+        """
+        self.data = data
+        
+        self.offset = tuple(int(x) for x in offset)
+        self._shape_ = tuple(int(x) for x in shape)
+        
+        self.dtype = numpy.dtype(data.dtype)
+        
+    @property
+    def shape(self):
+        return self._shape_
+    
+    @property
+    def ndim(self):
+        return len(self._shape_)
+    
+    @property
+    def size(self):
+        return int(numpy.prod(self._shape_))
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def __array__(self, dtype = None, copy = None):
+        
+        array = self[...]
+        
+        if dtype is not None:
+            array = array.astype(dtype, copy = False)
+            
+        return array
+    
+    def copy(self):
+        """
+        Create the padded array in RAM.
+        """
+        return self[...]
+    
+    def __getitem__(self, key):
+        
+        shape, scalar, inside, source = self._map_(key)
+        
+        block = numpy.zeros(shape, dtype = self.dtype)
+        
+        if all(ii.size > 0 for ii in inside):
+            
+            # Read the bounding box of the data and pick the elements that are not in a regular grid:
+            box = [ii if isinstance(ii, slice) else slice(ii.min(), ii.max() + 1) for ii in source]
+            
+            data = numpy.asarray(self.data[tuple(box)])
+            
+            for axis, ii in enumerate(source):
+                if not isinstance(ii, slice):
+                    data = data.take(ii - ii.min(), axis = axis)
+                    
+            block[numpy.ix_(*inside)] = data
+        
+        # Drop the dimensions that were indexed by an integer:
+        return block[tuple(0 if x else slice(None) for x in scalar)]
+    
+    def __setitem__(self, key, value):
+        """
+        Write to the data. Values that fall outside of the data are ignored.
+        """
+        shape, scalar, inside, source = self._map_(key)
+        
+        if any(ii.size == 0 for ii in inside): return
+        
+        squeezed = [n for n, x in zip(shape, scalar) if not x]
+        value = numpy.broadcast_to(numpy.asarray(value), squeezed).reshape(shape)
+        
+        value = value[numpy.ix_(*inside)]
+        
+        if all(isinstance(ii, slice) for ii in source):
+            self.data[tuple(source)] = value
+            
+        else:
+            source = [numpy.arange(ii.start, ii.stop, ii.step) if isinstance(ii, slice) else ii for ii in source]
+            self.data[numpy.ix_(*source)] = value
+    
+    def _map_(self, key):
+        """
+        Translate the key of the view to the data. Returns the shape of the block (integer indices count as size 1), 
+        flags of the integer indices, positions in the block that are inside the data and the key of the data (slices or arrays).
+        """
+        key = _expand_key_(key, self.ndim, 'PaddedArray', advanced = 1)
+        
+        index = [numpy.arange(n)[k] for n, k in zip(self.shape, key)]
+        
+        scalar = [numpy.ndim(ii) == 0 for ii in index]
+        shape = [numpy.size(ii) for ii in index]
+        
+        inside = []
+        source = []
+        
+        for ii, offset, n in zip(index, self.offset, self.data.shape):
+            
+            ii = numpy.atleast_1d(ii) + offset
+            valid = numpy.flatnonzero((ii >= 0) & (ii < n))
+            ii = ii[valid]
+            
+            inside.append(valid)
+            
+            # Regular increasing indices are read as slices (cheap for memmaps and TiffStacks):
+            step = int(ii[1] - ii[0]) if ii.size > 1 else 1
+            
+            if (ii.size > 0) & (step > 0) and (numpy.diff(ii) == step).all():
+                source.append(slice(int(ii[0]), int(ii[-1]) + 1, step))
+            else:
+                source.append(ii)
+                
+        return shape, scalar, inside, source
+    
+def pad(array, dim, width, symmetric = False, virtual = False):
+    """
+    Pad an array along the given dimension. If virtual is True (or the array is a PaddedArray), 
+    a PaddedArray view is returned instead of a padded copy.
     """
     padl = numpy.zeros(3, dtype = int)
     padr = numpy.zeros(3, dtype = int)
@@ -341,37 +1332,68 @@ def pad(array, dim, width, symmetric = False):
     
         else:
             padr[dim] = int(width)
+    
+    if virtual or isinstance(array, PaddedArray):
+        return _pad_view_(array, dim, padl[dim], padr[dim])
         
     return numpy.pad(array, ((padl[0], padr[0]), (padl[1], padr[1]), (padl[2], padr[2])), mode = 'constant')  
  
-def bin(array):
+def bin(array, factor = 2, memmap = None, dtype = None, workers = 1):
     """
-    Simple binning of the data:
-    """         
-    # First apply division by 8:
-    if array.dtype.kind == 'i':    
-        array //= 8
-    else:
-        array /= 8
+    Bin the data: average blocks of factor x factor x factor voxels. The input is not modified. It is processed 
+    slab by slab, so it can be a memmap (or a TiffStack) that doesn't fit in RAM. Trailing voxels that don't 
+    fill a whole block are dropped.
     
-    # Try to avoid memory overflow here:
-    for ii in range(array.shape[0]):
-        sl = flexUtil.anyslice(array, ii, 0)
+    Args:
+        array: 3D array, memmap or array-like
+        factor (int or list): binning factor - the same for all axes or one per axis
+        memmap (str): if provided, the result is a disk mapped array
+        dtype: data type of the result (default - the input data type)
+        workers (int): number of threads (each works on its own slab)
         
-        x = array[sl]
-        array[sl][:-1:2,:] += x[1::2,:]
-        array[sl][:,:-1:2] += x[:,1::2]
+    Returns:
+        binned array
+    """
+    factor = numpy.broadcast_to(numpy.int64(factor), (array.ndim,))
+    
+    shape = tuple(int(x) for x in numpy.array(array.shape) // factor)
+    dtype = numpy.dtype(dtype or array.dtype)
+    
+    if memmap:
+        binned = numpy.memmap(memmap, dtype = dtype, mode = 'w+', shape = shape)
+    else:
+        binned = numpy.zeros(shape, dtype = dtype)
         
-    for ii in range(array.shape[2]):
-        sl = flexUtil.anyslice(array, ii, 2)
+    # Integers are summed without overflow and rounded at the end:
+    integer = dtype.kind in 'iu'
+    count = int(numpy.prod(factor))
         
-        array[sl][:-1:2,:-1:2] += array[sl][1::2,:-1:2]    
+    def bin_slab(ii):
         
-    return array[:-1:2, :-1:2, :-1:2]
+        slab = numpy.asarray(array[ii * factor[0]:(ii + 1) * factor[0]])
+        slab = slab[(slice(None),) + tuple(slice(0, n * f) for n, f in zip(shape[1:], factor[1:]))]
+        
+        # Split every axis into (n, factor) and sum over the factors:
+        split = [factor[0]]
+        for n, f in zip(shape[1:], factor[1:]):
+            split += [n, f]
+            
+        slab = slab.reshape(split).sum(axis = tuple(range(0, len(split), 2)), dtype = 'int64' if slab.dtype.kind in 'iu' else 'float64')
+        
+        if integer:
+            binned[ii] = (slab + count // 2) // count
+        else:
+            binned[ii] = slab / count
+            
+    _map_progress_(bin_slab, range(shape[0]), workers)
+    
+    return binned
     
 def crop(array, dim, width, symmetric = False, geometry = None):
     """
-    Crop an array along the given dimension.
+    Crop an array along the given dimension. If a geometry is given, the detector is shifted 
+    to the centre of the cropped data: dictionaries are changed in place, for immutable Geometry records 
+    (array, geometry) is returned.
     """
     if numpy.size(width) > 1:
         widthl = int(width[0])
@@ -388,29 +1410,53 @@ def crop(array, dim, width, symmetric = False, geometry = None):
     # Geometry shifts:
     h = 0
     v = 0
+    
+    # Views are cropped without touching the data:
+    if isinstance(array, PaddedArray):
+        h, v = (widthl - widthr, 0) if dim > 0 else (0, widthl - widthr)
+        array = _pad_view_(array, dim, -widthl, -widthr)
         
-    if dim == 0:
+    elif dim == 0:
         v = (widthl - widthr)
-        array = array[widthl:-widthr, :,:]
+        array = array[widthl:array.shape[0] - widthr, :,:]
         
     elif dim == 1:
         h = (widthl - widthr)
-        array = array[:,widthl:-widthr,:]
+        array = array[:,widthl:array.shape[1] - widthr,:]
         
     elif dim == 2:
         h = (widthl - widthr)
-        array = array[:,:,widthl:-widthr]   
+        array = array[:,:,widthl:array.shape[2] - widthr]   
+    
+    if isinstance(geometry, Geometry): 
+        return array, shift_geometry(geometry, h/2, v/2)
     
-    print(h)
     if geometry: shift_geometry(geometry, h/2, v/2)
-    #if geometry: shift_geometry(geometry, -h/2, -v/2)
     
     return array
     
+def _pad_view_(array, dim, left, right):
+    """
+    PaddedArray view of the array with left and right elements added along dim (negative values crop).
+    """
+    if isinstance(array, PaddedArray):
+        offset, shape, array = list(array.offset), list(array.shape), array.data
+    else:
+        offset, shape = [0] * array.ndim, list(array.shape)
+        
+    offset[dim] -= left
+    shape[dim] += left + right
+    
+    return PaddedArray(array, offset, shape)
+    
 def raw2astra(array):
     """
     Convert a given numpy array (sorted: index, hor, vert) to ASTRA-compatible projections stack
     """    
+    # TiffStack knows how to produce an ASTRA view without reading the data:
+    if isinstance(array, TiffStack):
+        return TiffStack(array.files, array.layouts, array.dtype, array.dark, array.flat, astra = True)
+    
     # Don't apply ascontignuousarray on memmaps!    
     array = numpy.transpose(array, [1,0,2])
     
@@ -423,8 +1469,7 @@ def pixel2mm(value, geometry):
     """
     Convert pixels to millimetres by multiplying the value by img_pixel 
     """
-    m = (geometry['src2obj'] + geometry['det2obj']) / geometry['src2obj']
-    img_pixel = geometry['det_pixel'] / m
+    img_pixel = geometry['det_pixel'] / magnification(geometry)
 
     return value * img_pixel
       
@@ -432,25 +1477,63 @@ def mm2pixel(value, geometry):
     """
     Convert millimetres to pixels by dividing the value by img_pixel 
     """
-    m = (geometry['src2obj'] + geometry['det2obj']) / geometry['src2obj']
-    img_pixel = geometry['det_pixel'] / m
+    img_pixel = geometry['det_pixel'] / magnification(geometry)
 
     return value / img_pixel
 
 def shift_geometry(geometry, hrz, vrt):
     """
-    Apply geometry shift in pixels.
+    Apply geometry shift in pixels. Dictionaries are changed in place, Geometry records are immutable: 
+    use the returned geometry.
     """    
     hrz = hrz * geometry['det_pixel']
     vrt = vrt * geometry['det_pixel']
     
+    # Here we are computing magnification without taking into account vol_tra[1], det_mag
+    m = magnification(geometry)
+    
+    vol_tra = list(geometry['vol_tra'])
+    vol_tra[2] += hrz / m
+    vol_tra[0] += vrt / m
+    
+    if isinstance(geometry, Geometry):
+        return geometry.copy(det_hrz = geometry['det_hrz'] + hrz, det_vrt = geometry['det_vrt'] + vrt, vol_tra = vol_tra)
+    
     geometry['det_hrz'] += hrz
     geometry['det_vrt'] += vrt
+    geometry['vol_tra'][:] = vol_tra
     
-    # Here we are computing magnification without taking into account vol_tra[1], det_mag
-    m = (geometry['src2obj'] + geometry['det2obj']) / geometry['src2obj']
-    geometry['vol_tra'][2] += hrz / m
-    geometry['vol_tra'][0] += vrt / m    
+    return geometry
+    
+def set_thetas(geometry, index, skip = 1):
+    """
+    Use the index of the files that were read (see read_raw, read_projections) to set explicit angles (_thetas_) 
+    if some of the files were corrupted or missing. Dictionaries are changed in place, Geometry records are copied.
+    
+    Args:
+        geometry: geometry record
+        index (array): index of the files that were read
+        skip (int): skip that was used to read the files
+        
+    Returns:
+        geometry
+    """
+    index = numpy.array(index) // skip
+    
+    if (index.size == 0) or ((index[-1] + 1) == index.size):
+        return geometry
+    
+    print('Seemes like some files were corrupted or missing. We will try to correct thetas accordingly.')
+    
+    thetas = numpy.linspace(geometry['theta_min'], geometry['theta_max'], index[-1] + 1)
+    thetas = thetas[index]
+    
+    if isinstance(geometry, Geometry):
+        return geometry.copy(_thetas_ = thetas)
+    
+    geometry['_thetas_'] = thetas
+    
+    return geometry
     
 def astra_vol_geom(geometry, vol_shape, slice_first = None, slice_last = None, sample = [1, 1]):
     '''
@@ -477,8 +1560,8 @@ def astra_vol_geom(geometry, vol_shape, slice_first = None, slice_last = None, s
         offset = (slice_first + slice_last) / 2 - centre
         offset = offset * voxel[0]
         
-        shape = [slice_last - slice_first + 1, vol_shape[1], vol_shape[2]]
-        size = shape * voxel[0]
+        shape = numpy.array([slice_last - slice_first + 1, vol_shape[1], vol_shape[2]])
+        size = shape * voxel
 
     else:
         shape = vol_shape
@@ -493,6 +1576,60 @@ def astra_vol_geom(geometry, vol_shape, slice_first = None, slice_last = None, s
 def astra_proj_geom(geometry, data_shape, index = None, sample = [1, 1]):
     """
     Generate the vector that describes positions of the source and detector.
+    Results are cached: repeated calls with the same geometry, shape, index and sample don't recompute the vectors.
+    """
+    key = _proj_geom_key_(geometry, data_shape, index, sample)
+    
+    proj_geom = _proj_geom_cache_.get(key)
+    
+    if proj_geom is None:
+        proj_geom = _astra_proj_geom_(geometry, data_shape, index, sample)
+        
+        # Keep the cache small:
+        if len(_proj_geom_cache_) >= 256:
+            _proj_geom_cache_.pop(next(iter(_proj_geom_cache_)), None)
+            
+        _proj_geom_cache_[key] = proj_geom
+        
+    # Give every caller its own copy of the vectors:
+    proj_geom = proj_geom.copy()
+    proj_geom['Vectors'] = proj_geom['Vectors'].copy()
+    
+    return proj_geom
+
+def _proj_geom_key_(geometry, data_shape, index, sample):
+    """
+    Hashable key that describes everything astra_proj_geom depends on.
+    Geometry records are hashable themselves and remember their hash, so they are used as they are.
+    """
+    if index is not None:
+        index = numpy.asarray(index)
+        index = (index.dtype.str, index.shape, index.tobytes())
+    
+    shape = tuple(int(x) for x in data_shape)
+    sample = tuple(numpy.ravel(sample).tolist())
+    
+    if isinstance(geometry, Geometry):
+        return (geometry, shape, index, sample)
+    
+    keys = ['det_pixel', 'src2obj', 'det2obj', '_thetas_', 'theta_min', 'theta_max', 'det_vrt', 'det_hrz', 'det_mag', 
+            'src_vrt', 'src_hrz', 'src_mag', 'axs_hrz', 'det_rot', 'vol_rot', 'vol_tra']
+    
+    values = []
+    for k in keys:
+        v = geometry.get(k)
+        
+        # Lists and arrays are converted to tuples:
+        if v is not None and numpy.ndim(v) > 0:
+            v = tuple(numpy.ravel(v).tolist())
+            
+        values.append(v)
+    
+    return (tuple(values), shape, index, sample)
+
+def _astra_proj_geom_(geometry, data_shape, index = None, sample = [1, 1]):
+    """
+    Compute the vectors of the projection geometry for all angles at once.
     """
     # Basic geometry:
     det_count_x = data_shape[2]
@@ -506,7 +1643,7 @@ def astra_proj_geom(geometry, data_shape, index = None, sample = [1, 1]):
 
     # Check if _thetas_ are defined explicitly:
     if geometry.get('_thetas_') is not None:
-        thetas = geometry['_thetas_'] / 180 * numpy.pi
+        thetas = numpy.array(geometry['_thetas_']) / 180 * numpy.pi
         
         if len(thetas) != theta_count: 
             raise IndexError('Length of the _thetas_ array doesn`t match withthe number of projections: %u v.s. %u' % (len(thetas), theta_count))
@@ -514,204 +1651,985 @@ def astra_proj_geom(geometry, data_shape, index = None, sample = [1, 1]):
         
         thetas = numpy.linspace(geometry.get('theta_min'), geometry.get('theta_max'),theta_count, dtype = 'float32') / 180 * numpy.pi
 
-    # Inintialize ASTRA projection geometry to import vector from it
     if (index is not None):
         
         thetas = thetas[index]
        
-    proj_geom = astra.creators.create_proj_geom('cone', det_pixel[1], det_pixel[0], det_count_z, det_count_x, thetas, src2obj, det2obj)
+    # Standard cone geometry as vectors (same as astra.functions.geom_2vec):
+    thetas = numpy.atleast_1d(numpy.float64(thetas))
     
-    proj_geom = astra.functions.geom_2vec(proj_geom)
-      
-    vectors = proj_geom['Vectors']
+    sin = numpy.sin(thetas)[:, None]
+    cos = numpy.cos(thetas)[:, None]
+    zero = numpy.zeros_like(sin)
+    
+    src_vect = numpy.hstack([sin * src2obj, -cos * src2obj, zero])
+    det_vect = numpy.hstack([-sin * det2obj, cos * det2obj, zero])
+    det_axis_hrz = numpy.hstack([cos * det_pixel[1], sin * det_pixel[1], zero])
+    det_axis_vrt = numpy.hstack([zero, zero, zero + det_pixel[0]])
+    
+    #Precalculate vector perpendicular to the detector plane:
+    det_normal = numpy.cross(det_axis_hrz, det_axis_vrt)
+    det_normal /= numpy.sqrt((det_normal ** 2).sum(1))[:, None]
+    
+    # Translations relative to the detecotor plane:
+
+    #Detector shift (V):
+    det_vect += geometry['det_vrt'] * det_axis_vrt / det_pixel[0]
+
+    #Detector shift (H):
+    det_vect += geometry['det_hrz'] * det_axis_hrz / det_pixel[1]
+
+    #Detector shift (M):
+    det_vect += geometry['det_mag'] * det_normal /  det_pixel[1]
+
+    #Source shift (V):
+    src_vect += geometry['src_vrt'] * det_axis_vrt / det_pixel[0]
+
+    #Source shift (H):
+    src_vect += geometry['src_hrz'] * det_axis_hrz / det_pixel[1]
+
+    #Source shift (M):
+    src_vect += geometry['src_mag'] * det_normal / det_pixel[1]
+
+    # Rotation axis shift:
+    det_vect -= geometry['axs_hrz'] * det_axis_hrz  / det_pixel[1]
+    src_vect -= geometry['axs_hrz'] * det_axis_hrz  / det_pixel[1]
+
+    # Rotation relative to the detector plane (Rodrigues formula for every detector normal):
+    det_axis_hrz = _rotate_vectors_(det_axis_hrz, det_normal, -geometry['det_rot'])
+    det_axis_vrt = _rotate_vectors_(det_axis_vrt, det_normal, geometry['det_rot'])
+
+    # Global transformation:
+    # Rotation matrix based on Euler angles:
+    R = transforms3d.euler.euler2mat(geometry['vol_rot'][0], geometry['vol_rot'][1], geometry['vol_rot'][2], 'rzyx')
+
+    # Apply transformation:
+    det_axis_hrz = numpy.dot(det_axis_hrz, R)
+    det_axis_vrt = numpy.dot(det_axis_vrt, R)
+    src_vect = numpy.dot(src_vect, R)
+    det_vect = numpy.dot(det_vect, R)            
+            
+    # Add translation:
+    vect_norm = numpy.sqrt((det_axis_vrt ** 2).sum(1))
+
+    # Take into account that the center of rotation should be in the center of reconstruction volume:        
+    T = numpy.stack([geometry['vol_tra'][1] * vect_norm / det_pixel[1], geometry['vol_tra'][2] * vect_norm / det_pixel[1], 
+                     geometry['vol_tra'][0] * vect_norm / det_pixel[0]], axis = 1)    
+    
+    src_vect -= numpy.dot(T, R)           
+    det_vect -= numpy.dot(T, R)
     
-    # Modify vector and apply it to astra projection geometry:
-    for ii in range(0, vectors.shape[0]):
+    proj_geom = astra.creators.create_proj_geom('cone_vec', det_count_z, det_count_x, 
+                                                numpy.hstack([src_vect, det_vect, det_axis_hrz, det_axis_vrt]))
+    
+    return proj_geom   
+
+def _rotate_vectors_(vectors, axes, angle):
+    """
+    Rotate every vector around its own (normalized) axis by the same angle.
+    """
+    cos = numpy.cos(angle)
+    sin = numpy.sin(angle)
+    
+    dot = (axes * vectors).sum(1)[:, None]
+    
+    return vectors * cos + numpy.cross(axes, vectors) * sin + axes * dot * (1 - cos)
 
-        # Define vectors:
-        src_vect = vectors[ii, 0:3]    
-        det_vect = vectors[ii, 3:6]    
-        det_axis_hrz = vectors[ii, 6:9]          
-        det_axis_vrt = vectors[ii, 9:12]
+def create_geometry(src2obj, det2obj, det_pixel, theta_range):
+    """
+    Initialize an empty geometry record.
+    """
+    
+    # Create an empty dictionary:
+    geometry = {'det_pixel':det_pixel, 'det_hrz':0., 'det_vrt':0., 'det_mag':0., 
+    'src_hrz':0., 'src_vrt':0., 'src_mag':0., 'axs_hrz':0., 'det_rot':0., 
+    'vol_rot':[0. ,0. ,0.], 'vol_hrz':0., 'vol_tra':[0., 0., 0.], 'vol_mag':0.,
+    'src2obj': src2obj, 'det2obj':det2obj, 'unit':'millimetre', 'type':'flex', 'binning': 1}
+    
+    geometry['src2det'] = geometry.get('src2obj') + geometry.get('det2obj')
+    
+    # Add img_pixel:
+    if src2obj != 0:    
+        m = (src2obj + det2obj) / src2obj
+        geometry['img_pixel'] = det_pixel / m
+    else:
+        geometry['img_pixel'] = 0
+
+    # Generate thetas explicitly:
+    geometry['theta_max'] = theta_range[1]
+    geometry['theta_min'] = theta_range[0]
+    #geometry['theta_num'] = theta_count
 
-        #Precalculate vector perpendicular to the detector plane:
-        det_normal = numpy.cross(det_axis_hrz, det_axis_vrt)
-        det_normal = det_normal / numpy.sqrt(numpy.dot(det_normal, det_normal))
+    return geometry
+
+class Geometry(collections.abc.Mapping):
+    """
+    Immutable geometry record. Reads like a geometry dictionary (geometry['det_pixel'], geometry.get('vol_tra')),
+    but can't be modified in place: use geometry.copy(key = value) or copy_geometry to get a changed record.
+    Because it is immutable it is hashable (astra_proj_geom uses it as a cache key), copies are free, and
+    derived quantities like magnification are computed only once.
+
+    Lists are stored as tuples and arrays (_thetas_) as read-only arrays. to_dict() gives back the
+    usual dictionary, so Geometry(meta['geometry']).to_dict() == meta['geometry'] and write_meta works as before.
+    """
+    _fields_ = ('det_pixel', 'det_hrz', 'det_vrt', 'det_mag', 'det_rot', 'src_hrz', 'src_vrt', 'src_mag', 'axs_hrz',
+                'vol_rot', 'vol_hrz', 'vol_tra', 'vol_mag', 'src2obj', 'det2obj', 'src2det', 'img_pixel',
+                'theta_min', 'theta_max', 'theta_count', '_thetas_', 'unit', 'type', 'binning', 'roi')
+
+    __slots__ = _fields_ + ('_extra_', '_key_', '_magnification_')
+
+    def __init__(self, geometry = None, **changes):
+        """
+        Args:
+            geometry: geometry dictionary (or another Geometry)
+            changes: values to replace
+        """
+        values = dict(geometry) if geometry is not None else {}
+        values.update(changes)
+
+        extra = {}
+        for key, value in values.items():
+            value = _freeze_(value)
+
+            if key in self._fields_:
+                object.__setattr__(self, key, value)
+            else:
+                extra[key] = value
+
+        object.__setattr__(self, '_extra_', extra)
+        object.__setattr__(self, '_key_', None)
+        object.__setattr__(self, '_magnification_', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Geometry is immutable. Use copy(%s = ...) instead.' % name)
+
+    def __setitem__(self, key, value):
+        raise TypeError('Geometry is immutable. Use copy(%s = ...) instead.' % key)
+
+    def __getitem__(self, key):
+        if key in self._fields_:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+
+        return self._extra_[key]
+
+    def __iter__(self):
+        for key in self._fields_:
+            if hasattr(self, key): yield key
+
+        yield from self._extra_
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        if isinstance(other, Geometry):
+            return self.key == other.key
+
+        if isinstance(other, collections.abc.Mapping):
+            return self.key == Geometry(other).key
+
+        return NotImplemented
+
+    def __repr__(self):
+        return 'Geometry(%s)' % ', '.join('%s = %r' % (key, self[key]) for key in self if key != '_thetas_')
+
+    def __reduce__(self):
+        return (Geometry, (self.to_dict(),))
+
+    @property
+    def key(self):
+        """
+        Tuple of all values. Two geometries with the same key describe the same scan.
+        """
+        if self._key_ is None:
+            key = []
+            for name in sorted(self):
+                value = self[name]
+                if isinstance(value, numpy.ndarray):
+                    value = (value.dtype.str, value.shape, value.tobytes())
+
+                key.append((name, value))
+
+            object.__setattr__(self, '_key_', tuple(key))
+
+        return self._key_
+
+    @property
+    def magnification(self):
+        """
+        Magnification of the object on the detector: (src2obj + det2obj) / src2obj.
+        """
+        if self._magnification_ is None:
+            object.__setattr__(self, '_magnification_', (self['src2obj'] + self['det2obj']) / self['src2obj'])
+
+        return self._magnification_
+
+    @property
+    def object_pixel(self):
+        """
+        Size of the detector pixel in the object plane: det_pixel / magnification.
+        """
+        return self['det_pixel'] / self.magnification
+
+    def copy(self, **changes):
+        """
+        Copy the geometry replacing some of the values. Without changes returns the same (immutable) record.
+        """
+        if not changes:
+            return self
+
+        return Geometry(self, **changes)
+
+    def to_dict(self):
+        """
+        Convert to a geometry dictionary (the format used by read_log, read_meta and write_meta).
+        """
+        return {key: _thaw_(self[key]) for key in self}
+
+    @classmethod
+    def from_dict(cls, geometry):
+        """
+        Create a record from a geometry dictionary.
+        """
+        return cls(geometry)
+
+def _freeze_(value):
+    """
+    Immutable version of a geometry value.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze_(v) for v in value)
+
+    if isinstance(value, numpy.ndarray):
+        value = value.copy()
+        value.flags.writeable = False
+
+    return value
+
+def _thaw_(value):
+    """
+    Mutable version of a geometry value.
+    """
+    if isinstance(value, tuple):
+        return [_thaw_(v) for v in value]
+
+    if isinstance(value, numpy.ndarray):
+        return value.copy()
+
+    return value
+
+def magnification(geometry):
+    """
+    Magnification of the object on the detector. Geometry records compute it only once.
+    """
+    if isinstance(geometry, Geometry):
+        return geometry.magnification
+
+    return (geometry['src2obj'] + geometry['det2obj']) / geometry['src2obj']
+
+def copy_geometry(geometry, **changes):
+    """
+    Copy a geometry record (dictionary or Geometry) and replace some of the values. Unlike dict.copy()
+    lists like vol_tra are copied too, so changing the copy doesn't change the original.
+    """
+    if isinstance(geometry, Geometry):
+        return geometry.copy(**changes)
+
+    geometry = copy.deepcopy(geometry)
+    geometry.update(changes)
+
+    return geometry
+
+def detector_size(shape, geometry):
+    '''
+    Get the size of detector in mm.
+    '''       
+    return geometry['det_pixel'] * numpy.array(shape)
+
+def detector_bounds(shape, geometry):
+    '''
+    Get the boundaries of the detector in mm
+    '''   
+    bounds = {}
+
+    xmin = geometry['det_hrz'] - geometry['det_pixel'] * shape[2] / 2
+    xmax = geometry['det_hrz'] + geometry['det_pixel'] * shape[2] / 2
+
+    ymin = geometry['det_vrt'] - geometry['det_pixel'] * shape[0] / 2
+    ymax = geometry['det_vrt'] + geometry['det_pixel'] * shape[0] / 2
+
+    bounds['hrz'] = [xmin, xmax]
+    bounds['vrt'] = [ymin, ymax]
+    
+    return bounds 
+    
+def tiles_shape(shape, geometry_list):
+    """
+    Compute the size of the stiched dataset.
+    Args:
+        shape: shape of a single projection stack.
+        geometry_list: list of geometries.
         
-        # Translations relative to the detecotor plane:
+    """
+    # Phisical detector size:
+    min_x, min_y = numpy.inf, numpy.inf
+    max_x, max_y = -numpy.inf, -numpy.inf
     
-        #Detector shift (V):
-        det_vect += geometry['det_vrt'] * det_axis_vrt / det_pixel[0]
+    det_pixel = geometry_list[0]['det_pixel']
+    
+    # Find out the size required for the final dataset
+    for geo in geometry_list:
+        
+        bounds = detector_bounds(shape, geo)
+        
+        min_x = min([min_x, bounds['hrz'][0]])
+        min_y = min([min_y, bounds['vrt'][0]])
+        max_x = max([max_x, bounds['hrz'][1]])
+        max_y = max([max_y, bounds['vrt'][1]])
+        
+    # Big slice:
+    new_shape = numpy.array([(max_y - min_y) / det_pixel, shape[1], (max_x - min_x) / det_pixel])                     
+    new_shape = numpy.int32(numpy.ceil(new_shape))  
+    
+    # Copy one of the geometry records and sett the correct translation (copy_geometry doesn't share vol_tra with the original):
+    geometry = geometry_list[0]
+    
+    det_hrz = (max_x + min_x) / 2
+    det_vrt = (max_y + min_y) / 2
+    
+    # Update volume center:
+    #geometry['vol_vrt'] = (geometry['det_vrt'] * geometry['src2obj'] + geometry['src_vrt'] * geometry['det2obj']) / geometry.get('src2det')
+    #geometry['vol_hrz'] = (geometry['det_hrz'] + geometry['src_hrz']) / 2
+    vol_tra = list(geometry['vol_tra'])
+    vol_tra[0] = (det_vrt * geometry['src2obj'] + geometry['src_vrt'] * geometry['det2obj']) / geometry.get('src2det')
+    #geometry['vol_tra'][2] = (geometry['det_hrz'] + geometry['src_hrz']) / 2
+    vol_tra[2] = geometry['axs_hrz']
+    
+    geometry = copy_geometry(geometry, det_hrz = det_hrz, det_vrt = det_vrt, vol_tra = vol_tra)
 
-        #Detector shift (H):
-        det_vect += geometry['det_hrz'] * det_axis_hrz / det_pixel[1]
+    return new_shape, geometry
+                 
+def _read_tiff_(file, sample = [1, 1], x_roi = [], y_roi = [], average = False):
+    """
+    Read a single image. If the layout of the TIFF file allows it, only the strips that intersect y_roi 
+    (and only every sample[0]-th row) are read from disk. Otherwise the whole image is decoded and cropped.
+    If average is True, blocks of sample[0] x sample[1] pixels are averaged instead of decimated.
+    """
+    if average:
+        im = _read_tiff_(file, [1, 1], x_roi, y_roi)
+        
+        return _bin_image_(im, sample)
+    
+    import struct
+    
+    # Try to read only the rows that we need (truncated headers raise struct.error):
+    try:
+        layout = _tiff_layout_(file)
+    
+    except (ValueError, struct.error):
+        layout = None
+        
+    if layout and _strips_readable_(layout):
+        im = _read_tiff_rows_(file, layout, sample[0], y_roi)
+        
+    else:
+        import imageio
+        
+        im = imageio.imread(file)
+        
+        if (y_roi != []):
+            im = im[y_roi[0]:y_roi[1], :]
+            
+        im = im[::sample[0]]
+        
+    if (x_roi != []):
+        im = im[:, x_roi[0]:x_roi[1]]
+
+    im = im[:, ::sample[1]]
+    
+    return im
+
+def _tiff_layout_(file):
+    """
+    Parse the header of a TIFF file and return the layout of its first image: shape, dtype, compression, 
+    strip offsets and byte counts. Raises ValueError if the file is not a classic TIFF.
+    """
+    import struct
+    
+    # Tag types and their sizes in bytes:
+    types = {1:'B', 2:'B', 3:'H', 4:'I', 6:'b', 7:'B', 8:'h', 9:'i', 16:'Q'}
+    
+    with open(file, 'rb') as f:
+        
+        head = f.read(8)
+        
+        if head[:2] == b'II':
+            order = '<'
+        elif head[:2] == b'MM':
+            order = '>'
+        else:
+            raise ValueError('Not a TIFF file: ' + file)
+            
+        magic, ifd = struct.unpack(order + 'HI', head[2:8])
+        
+        if magic != 42: raise ValueError('Only classic TIFF files are supported: ' + file)
+        
+        # Read the image file directory:
+        f.seek(ifd)
+        count = struct.unpack(order + 'H', f.read(2))[0]
+        entries = f.read(12 * count)
+        
+        if len(entries) != 12 * count: raise ValueError('Truncated TIFF header: ' + file)
+        
+        tags = {}
+        
+        for ii in range(count):
+            tag, typ, num = struct.unpack(order + 'HHI', entries[ii*12:ii*12+8])
+            
+            # Skip tags that we don't need (rationals, floats, strings):
+            if typ not in types: continue
+        
+            fmt = order + '%u' % num + types[typ]
+            size = struct.calcsize(fmt)
+            
+            if size <= 4:
+                value = entries[ii*12+8:ii*12+8+size]
+            else:
+                pos = f.tell()
+                f.seek(struct.unpack(order + 'I', entries[ii*12+8:ii*12+12])[0])
+                value = f.read(size)
+                f.seek(pos)
+                
+            if len(value) != size: raise ValueError('Truncated TIFF header: ' + file)
+            
+            tags[tag] = struct.unpack(fmt, value)
+    
+    if (256 not in tags) or (257 not in tags): raise ValueError('Image size is not defined: ' + file)
+    
+    # Sample format and bits per sample define the data type:
+    bits = tags.get(258, (1,))[0]
+    kind = {1:'u', 2:'i', 3:'f'}.get(tags.get(339, (1,))[0])
+    
+    if (kind is None) or (bits % 8 != 0): raise ValueError('Unsupported data type: ' + file)
+        
+    height = tags[257][0]
+    
+    layout = {'shape': (height, tags[256][0]),
+              'dtype': numpy.dtype(order + kind + '%u' % (bits // 8)), 
+              'samples': tags.get(277, (1,))[0],
+              'planar': tags.get(284, (1,))[0],
+              'compression': tags.get(259, (1,))[0],
+              'predictor': tags.get(317, (1,))[0],
+              'tiled': 322 in tags,
+              'rows_per_strip': min(tags.get(278, (height,))[0], height),
+              'offsets': numpy.array(tags.get(273, ()), dtype = 'int64'),
+              'counts': numpy.array(tags.get(279, ()), dtype = 'int64')}
+    
+    return layout
+
+def _strips_readable_(layout):
+    """
+    Check if the image can be read strip by strip without an external decoder.
+    """
+    return ((not layout['tiled']) & (layout['planar'] == 1) & (layout['predictor'] == 1) & 
+            (layout['compression'] in [1, 8, 32946]) & (layout['offsets'].size > 0) &
+            (layout['offsets'].size == layout['counts'].size))
 
-        #Detector shift (M):
-        det_vect += geometry['det_mag'] * det_normal /  det_pixel[1]
+def _strips_contiguous_(layout):
+    """
+    Check if the image is uncompressed and all strips follow each other in the file without gaps.
+    """
+    offsets = layout['offsets']
+    counts = layout['counts']
+    
+    return (_strips_readable_(layout) & (layout['compression'] == 1) & 
+            numpy.all(offsets[1:] == offsets[:-1] + counts[:-1]))
 
-        #Source shift (V):
-        src_vect += geometry['src_vrt'] * det_axis_vrt / det_pixel[0]
+def _read_tiff_rows_(file, layout, step = 1, y_roi = []):
+    """
+    Read every step-th row within y_roi using the strip layout of a TIFF file.
+    """
+    height, width = layout['shape']
+    rps = layout['rows_per_strip']
+    dtype = layout['dtype']
+    
+    # Shape of a single row:
+    row_shape = (width, layout['samples']) if layout['samples'] > 1 else (width,)
+    
+    # Rows that we need:
+    rows = numpy.arange(height)
+    
+    if (y_roi != []):
+        rows = rows[y_roi[0]:y_roi[1]]
+        
+    rows = rows[::step]
+    
+    if _strips_contiguous_(layout):
+        
+        # Uncompressed image is just an array at some offset - let the OS read only the pages that we touch:
+        image = numpy.memmap(file, dtype = dtype, mode = 'r', offset = int(layout['offsets'][0]), shape = (height,) + row_shape)
+        im = numpy.array(image[rows])
+        
+        del image
+        
+        return im
+    
+    import zlib
+    
+    im = numpy.zeros((rows.size,) + row_shape, dtype = dtype)
+    strips = rows // rps
+    
+    with open(file, 'rb') as f:
+        
+        # Decode only the strips that intersect the ROI:
+        for strip in numpy.unique(strips):
+            
+            f.seek(layout['offsets'][strip])
+            buffer = f.read(layout['counts'][strip])
+            
+            if layout['compression'] != 1:
+                buffer = zlib.decompress(buffer)
+                
+            block = numpy.frombuffer(buffer, dtype = dtype).reshape((-1,) + row_shape)
+            
+            select = (strips == strip)
+            im[select] = block[rows[select] - strip * rps]
+    
+    return im
+    
+def _bin_image_(image, sample):
+    """
+    Average blocks of sample[0] x sample[1] pixels. Pixels that don't fill a whole block are discarded.
+    """
+    s0, s1 = sample
+    
+    if (s0 == 1) & (s1 == 1):
+        return image
+    
+    h = image.shape[0] // s0
+    w = image.shape[1] // s1
+    
+    image = image[:h * s0, :w * s1]
+    image = image.reshape((h, s0, w, s1) + image.shape[2:])
+    
+    # Accumulate in float to avoid integer overflow:
+    return image.mean(axis = (1, 3), dtype = 'float32')
 
-        #Source shift (H):
-        src_vect += geometry['src_hrz'] * det_axis_hrz / det_pixel[1]
+def _chunk_codec_(codec):
+    """
+    Get compress and decompress functions of a codec.
+    """
+    if codec is None:
+        return (lambda x: x), (lambda x: x)
+    
+    elif codec == 'zlib':
+        import zlib
+        return (lambda x: zlib.compress(x, 1)), zlib.decompress
+    
+    elif codec == 'lzma':
+        import lzma
+        return lzma.compress, lzma.decompress
+    
+    elif codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+    
+    else:
+        raise ValueError('Unknown codec: ' + str(codec))
 
-        #Source shift (M):
-        src_vect += geometry['src_mag'] * det_normal / det_pixel[1]
+def _expand_key_(key, ndim, name, advanced = None):
+    """
+    Turn an index key into a tuple with one entry per dimension: Ellipsis and the missing dimensions become full slices.
+    If advanced is given, keys with more index arrays than that are rejected (containers that index every dimension 
+    separately would return a different shape than numpy).
+    """
+    if not isinstance(key, tuple): 
+        key = (key,)
+        
+    if any(k is None for k in key):
+        raise IndexError('New axes are not supported by ' + name + '.')
+        
+    ellipsis = [ii for ii, k in enumerate(key) if k is Ellipsis]
+    
+    if len(ellipsis) > 1:
+        raise IndexError('An index can only have a single ellipsis.')
+        
+    if ellipsis:
+        ii = ellipsis[0]
+        key = key[:ii] + (slice(None),) * max(0, ndim - len(key) + 1) + key[ii + 1:]
+        
+    if len(key) > ndim: raise IndexError('Too many indices for ' + name + '.')
+    
+    if (advanced is not None) and (sum(numpy.ndim(k) > 0 for k in key if not isinstance(k, slice)) > advanced):
+        raise IndexError(name + ' supports only one index array per key. Index the dimensions one after another instead.')
+    
+    return key + (slice(None),) * (ndim - len(key))
 
-        # Rotation axis shift:
-        det_vect -= geometry['axs_hrz'] * det_axis_hrz  / det_pixel[1]
-        src_vect -= geometry['axs_hrz'] * det_axis_hrz  / det_pixel[1]
+def _chunk_ranges_(start, stop, step, chunk):
+    """
+    For a range of indexes find the chunks that it intersects with. 
+    Returns a list of [chunk index, slice in the output, slice in the chunk].
+    """
+    count = len(range(start, stop, step))
+    
+    ranges = []
+    
+    if count == 0:
+        return ranges
+    
+    last = start + (count - 1) * step
+    
+    for c in range(start // chunk, last // chunk + 1):
+        
+        c0 = c * chunk
+        c1 = c0 + chunk
+        
+        # First and last+1 positions of the range that fall into the chunk:
+        n0 = max(0, -(-(c0 - start) // step))
+        n1 = min(count, -(-(c1 - start) // step))
+        
+        if n1 > n0:
+            l0 = start + n0 * step - c0
+            ranges.append([c, slice(n0, n1), slice(l0, l0 + (n1 - n0 - 1) * step + 1, step)])
+        
+    return ranges
 
-        # Rotation relative to the detector plane:
-        # Compute rotation matrix
+def _map_progress_(function, items, workers = 1, count = None):
+    """
+    Apply a function to every item (in a thread pool if workers > 1) and show the progress. 
+    Items can be a generator: at most 2 x workers items are in flight at any time.
+    """
+    from collections import deque
     
-        T = transforms3d.axangles.axangle2mat(det_normal, geometry['det_rot'])
+    if count is None:
+        count = len(items)
+        
+    if workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        
+        pool = ThreadPoolExecutor(max_workers = workers)
+        
+    else:
+        pool = None
         
-        det_axis_hrz[:] = numpy.dot(T.T, det_axis_hrz)
-        det_axis_vrt[:] = numpy.dot(T, det_axis_vrt)
+    pending = deque()
+    done = 0
     
-        # Global transformation:
-        # Rotation matrix based on Euler angles:
-        R = transforms3d.euler.euler2mat(geometry['vol_rot'][0], geometry['vol_rot'][1], geometry['vol_rot'][2], 'rzyx')
-
-        # Apply transformation:
-        det_axis_hrz[:] = numpy.dot(det_axis_hrz, R)
-        det_axis_vrt[:] = numpy.dot(det_axis_vrt, R)
-        src_vect[:] = numpy.dot(src_vect,R)
-        det_vect[:] = numpy.dot(det_vect,R)            
+    try:
+        for item in items:
+            
+            if pool:
+                pending.append(pool.submit(function, item))
+            else:
+                function(item)
+                done += 1
+            
+            # Wait for the oldest item if there are too many in flight:
+            while len(pending) >= 2 * workers:
+                pending.popleft().result()
+                done += 1
                 
-        # Add translation:
-        vect_norm = numpy.sqrt((det_axis_vrt ** 2).sum())
+            flexUtil.progress_bar(done / count)
+            
+        while pending:
+            pending.popleft().result()
+            done += 1
+            
+            flexUtil.progress_bar(done / count)
+            
+    finally:
+        if pool: pool.shutdown()
 
-        # Take into account that the center of rotation should be in the center of reconstruction volume:        
-        # T = numpy.array([geometry['vol_mag'] * vect_norm / det_pixel[1], geometry['vol_hrz'] * vect_norm / det_pixel[1], geometry['vol_vrt'] * vect_norm / det_pixel[0]])    
-        T = numpy.array([geometry['vol_tra'][1] * vect_norm / det_pixel[1], geometry['vol_tra'][2] * vect_norm / det_pixel[1], geometry['vol_tra'][0] * vect_norm / det_pixel[0]])    
+def prefetch(function, items, depth = 1, memory = None):
+    """
+    Iterate over function(item) for all items. The next items are loaded in a background thread 
+    while the current one is used, e.g.: for proj, meta in prefetch(flexCompute.process_flex, paths): ...
+    
+    Args:
+        function: function that loads an item (e.g. flexCompute.process_flex)
+        items (list): arguments of the function
+        depth (int): maximum number of items that are loaded in advance
+        memory (float): maximum number of bytes (RAM) used by the results that are loaded in advance. 
+                        The size of a result is estimated from the previous results. Memmaps don't count.
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    
+    items = iter(items)
+    pending = deque()
+    
+    # Size of the biggest result so far:
+    size = 0
+    
+    with ThreadPoolExecutor(max_workers = 1) as pool:
         
-        src_vect[:] -= numpy.dot(T, R)           
-        det_vect[:] -= numpy.dot(T, R)
+        def submit():
+            for item in items:
+                pending.append(pool.submit(function, item))
+                return True
+            
+            return False
         
-    #print('vol_tra', geometry['vol_tra'])
-    #print('det_pixel', det_pixel)
-    #print('vect_norm', vect_norm)
-    #print('T', T)
-    
+        while pending or submit():
+            
+            result = pending.popleft().result()
+            size = max(size, _nbytes_(result))
+            
+            # Start loading the next items if they fit next to this one:
+            while (len(pending) < depth) and ((memory is None) or (size * (len(pending) + 2) <= memory)):
+                if not submit(): break
+            
+            yield result
+            
+            result = None
         
-    proj_geom['Vectors'] = vectors    
+def _nbytes_(value):
+    """
+    RAM used by the arrays in a (nested) result. Memmaps are not counted.
+    """
+    if isinstance(value, numpy.memmap):
+        return 0
     
-    return proj_geom   
-
-def create_geometry(src2obj, det2obj, det_pixel, theta_range):
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    
+    if isinstance(value, ScaledArray):
+        return _nbytes_(value.data)
+    
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes_(x) for x in value)
+    
+    if isinstance(value, dict):
+        return sum(_nbytes_(x) for x in value.values())
+    
+    return 0
+    
+def _bounds_(data, quantiles = None, workers = 1):
     """
-    Initialize an empty geometry record.
+    Compute the range of the data slab by slab (in parallel if workers > 1). If quantiles are given (e.g. [0.001, 0.999]), 
+    estimate them from a subsample of a few evenly spaced slices instead of reading all of the data.
     """
+    if quantiles is not None:
+        
+        # Up to 32 slices and about 10^7 values:
+        index = numpy.unique(numpy.linspace(0, data.shape[0] - 1, min(32, data.shape[0])).astype('int'))
+        step = max(1, int(numpy.sqrt(numpy.prod(data.shape[1:]) * index.size / 1e7)))
+        
+        # Subsample the other dimensions (any number of them):
+        sub = (slice(None, None, step),) * (data.ndim - 1)
+        sample = numpy.concatenate([numpy.ravel(data[ii][sub]) for ii in index])
+        
+        return [float(x) for x in numpy.quantile(sample, quantiles)]
     
-    # Create an empty dictionary:
-    geometry = {'det_pixel':det_pixel, 'det_hrz':0., 'det_vrt':0., 'det_mag':0., 
-    'src_hrz':0., 'src_vrt':0., 'src_mag':0., 'axs_hrz':0., 'det_rot':0., 
-    'vol_rot':[0. ,0. ,0.], 'vol_hrz':0., 'vol_tra':[0., 0., 0.], 'vol_mag':0.,
-    'src2obj': src2obj, 'det2obj':det2obj, 'unit':'millimetre', 'type':'flex', 'binning': 1}
+    # Slabs of about 64 MB:
+    step = max(1, int(2**24 // max(1, numpy.prod(data.shape[1:]))))
     
-    geometry['src2det'] = geometry.get('src2obj') + geometry.get('det2obj')
+    def slab_range(ii):
+        slab = data[ii:ii + step]
+        return slab.min(), slab.max()
     
-    # Add img_pixel:
-    if src2obj != 0:    
-        m = (src2obj + det2obj) / src2obj
-        geometry['img_pixel'] = det_pixel / m
+    if workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            ranges = list(pool.map(slab_range, range(0, data.shape[0], step)))
     else:
-        geometry['img_pixel'] = 0
-
-    # Generate thetas explicitly:
-    geometry['theta_max'] = theta_range[1]
-    geometry['theta_min'] = theta_range[0]
-    #geometry['theta_num'] = theta_count
-
-    return geometry 
+        ranges = [slab_range(ii) for ii in range(0, data.shape[0], step)]
         
-def detector_size(shape, geometry):
-    '''
-    Get the size of detector in mm.
-    '''       
-    return geometry['det_pixel'] * numpy.array(shape)
+    return [min(r[0] for r in ranges), max(r[1] for r in ranges)]
 
-def detector_bounds(shape, geometry):
-    '''
-    Get the boundaries of the detector in mm
-    '''   
-    bounds = {}
-
-    xmin = geometry['det_hrz'] - geometry['det_pixel'] * shape[2] / 2
-    xmax = geometry['det_hrz'] + geometry['det_pixel'] * shape[2] / 2
-
-    ymin = geometry['det_vrt'] - geometry['det_pixel'] * shape[0] / 2
-    ymax = geometry['det_vrt'] + geometry['det_pixel'] * shape[0] / 2
-
-    bounds['hrz'] = [xmin, xmax]
-    bounds['vrt'] = [ymin, ymax]
-    
-    return bounds 
-    
-def tiles_shape(shape, geometry_list):
+def _pyramid_add_(level, image, path, name, dtype = None, bounds = None):
     """
-    Compute the size of the stiched dataset.
-    Args:
-        shape: shape of a single projection stack.
-        geometry_list: list of geometries.
-        
+    Add a slice to the accumulator of a pyramid level. When factor slices are collected, 
+    write their average binned by factor in-plane.
     """
-    # Phisical detector size:
-    min_x, min_y = numpy.inf, numpy.inf
-    max_x, max_y = -numpy.inf, -numpy.inf
+    factor = level['factor']
     
-    det_pixel = geometry_list[0]['det_pixel']
+    if level['sum'] is None:
+        level['sum'] = numpy.zeros(image.shape, dtype = 'float32')
+        
+    level['sum'] += image
+    level['count'] += 1
     
-    # Find out the size required for the final dataset
-    for geo in geometry_list:
+    if level['count'] == factor:
         
-        bounds = detector_bounds(shape, geo)
+        img = _bin_image_(level['sum'] / factor, [factor, factor])
         
-        min_x = min([min_x, bounds['hrz'][0]])
-        min_y = min([min_y, bounds['vrt'][0]])
-        max_x = max([max_x, bounds['hrz'][1]])
-        max_y = max([max_y, bounds['vrt'][1]])
+        if dtype is not None:
+            img = cast2type(img, dtype, bounds)
         
-    # Big slice:
-    new_shape = numpy.array([(max_y - min_y) / det_pixel, shape[1], (max_x - min_x) / det_pixel])                     
-    new_shape = numpy.int32(numpy.ceil(new_shape))  
+        write_tiff(os.path.join(path, name + '_%06u.tiff'% level['index']), img)
+        
+        level['sum'][:] = 0
+        level['count'] = 0
+        level['index'] += 1
+
+def _compact_(data, good, axis = 0):
+    """
+    Remove the frames that are not in good (sorted indexes along the axis) by moving the good frames forward inside the same buffer.
+    Returns a C-contiguous array (or memmap) of the reduced shape that uses the beginning of the original buffer - 
+    no copy of the whole stack is made.
+    """
+    shape = list(data.shape)
     
-    # Copy one of the geometry records and sett the correct translation:
-    geometry = geometry_list[0].copy()
+    # The array is seen as [outer, frame, inner]:
+    outer = int(numpy.prod(shape[:axis]))
+    inner = int(numpy.prod(shape[axis + 1:]))
     
-    geometry['det_hrz'] = (max_x + min_x) / 2
-    geometry['det_vrt'] = (max_y + min_y) / 2
+    n = len(good)
+    good = numpy.asarray(good)
     
-    # Update volume center:
-    #geometry['vol_vrt'] = (geometry['det_vrt'] * geometry['src2obj'] + geometry['src_vrt'] * geometry['det2obj']) / geometry.get('src2det')
-    #geometry['vol_hrz'] = (geometry['det_hrz'] + geometry['src_hrz']) / 2
-    geometry['vol_tra'][0] = (geometry['det_vrt'] * geometry['src2obj'] + geometry['src_vrt'] * geometry['det2obj']) / geometry.get('src2det')
-    #geometry['vol_tra'][2] = (geometry['det_hrz'] + geometry['src_hrz']) / 2
-    geometry['vol_tra'][2] = geometry['axs_hrz']
-
-    return new_shape, geometry
-                 
-def _read_tiff_(file, sample = [1, 1], x_roi = [], y_roi = []):
+    flat = data.reshape(-1)
+    source = data.reshape(outer, shape[axis], inner)
+    
+    # Frames at the beginning that are already in place:
+    first = numpy.flatnonzero(good != numpy.arange(n))
+    first = first[0] if first.size else n
+    
+    # Blocks of about 64 MB:
+    step = max(1, int(2**24 // max(1, inner)))
+    
+    # Every element moves backward (or stays), so copying in the order of the buffer never overwrites unread frames:
+    for ii in range(outer):
+        for jj in range(first if ii == 0 else 0, n, step):
+            
+            block = source[ii, good[jj:jj + step]]
+            
+            start = (ii * n + jj) * inner
+            flat[start:start + block.size] = block.ravel()
+    
+    shape[axis] = n
+    
+    return flat[:outer * n * inner].reshape(shape)
+    
+def _flatfield_(image, dark, flat):
     """
-    Read a single image.
+    Apply flat-field correction and minus-log to a block of raw data in place. 
+    Dark and flat are images that broadcast against the block.
     """
-    import imageio
+    image -= dark
+    image /= (flat - dark)
     
-    im = imageio.imread(file, offset = 0)
+    numpy.log(image, out = image)
+    image *= -1
     
-    # TODO: Use kwags offset  and size to apply roi!
+    # Fix nans and infs after log:
+    image[~numpy.isfinite(image)] = 0
     
-    if (y_roi != []):
-        im = im[y_roi[0]:y_roi[1], :]
-    if (x_roi != []):
-        im = im[:, x_roi[0]:x_roi[1]]
+    return image
 
-    if sample != 1:
-        im = im[::sample[0], ::sample[1]]
+def _probe_shape_(files, sample = [1, 1], x_roi = [], y_roi = [], average = False):
+    """
+    Shape of the first image in the list of files (or groups of files) that can be read. Corrupted files are skipped.
+    """
+    for group in files:
+        for file in (group if isinstance(group, list) else [group]):
+            try:
+                return numpy.shape(_read_tiff_(file, sample, x_roi, y_roi, average))
+            
+            except Exception:
+                pass
+            
+    raise IOError('None of the files can be read:', files[0])
     
-    return im
+def _read_files_(files, data, sample = [1, 1], x_roi = [], y_roi = [], workers = 1, average = False, dark = None, flat = None, astra = False):
+    """
+    Read a list of image files into the slots of a preallocated array (or memmap).
+    
+    Args:
+        files (list): file names, one per slot along the first dimension of data. An element can be a list of files that will be averaged.
+        data (numpy.array): preallocated output array
+        sample, x_roi, y_roi, average: see read_raw
+        workers (int): number of threads used to decode files concurrently
+        dark, flat (numpy.array): if provided, apply flat-field correction and minus-log to every image
+        astra (bool): if True, the slots are along the second dimension of data and images are flipped (see raw2astra)
+        
+    Returns:
+        list : sorted indexes of the files that were read successfully
+    """
+    def read_one(k):
+        
+        group = files[k] if isinstance(files[k], list) else [files[k],]
+        
+        total = None
+        count = 0
+        
+        # Files in a group that fail to read are left out of the average:
+        for file in group:
+            try:
+                a = _read_tiff_(file, sample, x_roi, y_roi, average)
+                
+                # Summ RGB:    
+                if a.ndim > 2:
+                    a = a.mean(2)
+                    
+                if total is None:
+                    total = a
+                else:
+                    # Accumulate in float to avoid integer overflow:
+                    total = total + numpy.float32(a)
+                    
+                count += 1
+            
+            except:
+                pass
+            
+        if count == 0:
+            return False
+        
+        if count > 1:
+            total = total / count
+        
+        if (dark is not None) & (flat is not None):
+            total = _flatfield_(numpy.array(total, dtype = 'float32'), dark, flat)
+            
+        # Don't truncate averages if stored as integers:
+        if numpy.dtype(data.dtype).kind in 'iu':
+            total = numpy.round(total)
+            
+        # Each thread writes directly to its own slot:
+        if astra:
+            data[:, k, :] = total[::-1]
+        else:
+            data[k, :, :] = total
+            
+        return True
+            
+    file_n = len(files)
+    
+    if workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        
+        pool = ThreadPoolExecutor(max_workers = workers)
+        
+        # map returns the results in the order of the files:
+        results = pool.map(read_one, range(file_n))
+        
+    else:
+        pool = None
+        results = map(read_one, range(file_n))
+    
+    good = []
+    
+    try:
+        for k, success in enumerate(results):
+            if success:
+                good.append(k)
+            else:
+                print('\nWARNING! Failed to read:', files[k])
+                
+            flexUtil.progress_bar((k+1) / file_n)
+            
+    finally:
+        if pool: pool.shutdown()
+        
+    return good
 
 def _get_flexray_keywords_():                  
     """
@@ -808,7 +2726,7 @@ def _parse_keywords_(path, file_mask, dictionary, separator = ':'):
     '''
     
     # Try to find the log file in the selected path and file_mask
-    log_file = [x for x in os.listdir(path) if (os.path.isfile(os.path.join(path, x)) and file_mask in os.path.join(path, x))]
+    log_file = [x for x in _get_manifest_(path)['files'] if file_mask in os.path.join(path, x)]
 
     # Check if there is one file:
     if len(log_file) == 0:
@@ -821,7 +2739,7 @@ def _parse_keywords_(path, file_mask, dictionary, separator = ':'):
         log_file = os.path.join(path, log_file[0])
 
     # Create an empty geometry dictionary:
-    geometry = create_geometry(0, 0, 0, [0, 360], 0)
+    geometry = create_geometry(0, 0, 0, [0, 360])
 
     settings = {}
     description = {}
@@ -897,24 +2815,248 @@ def _parse_unit_(string):
 
     return factor    
              
+def _select_files_(path, name, skip = 1, average = False, frames = None):
+    """
+    Get every skip-th file sorted by name and its index. If average is True, each element of the file list is 
+    a group of files: the selected file and the skipped files that follow it. If frames are given, 
+    get the files with these indexes instead (missing files are left out).
+    """
+    files, indx = _get_files_indexed_(path, name)
+    
+    if frames is not None:
+        lookup = dict(zip(indx.tolist(), files))
+        frames = [int(ii) for ii in frames if int(ii) in lookup]
+        
+        return [lookup[ii] for ii in frames], numpy.array(frames, dtype = 'int64')
+    
+    if indx.size > 1:
+        
+        #print([ii for ii in numpy.where(indx % skip == 0)])
+        reduc = numpy.where(indx % skip == 0)[0]
+        
+        if average & (skip > 1):
+            
+            # Each file that we keep is averaged with the skipped files that follow it:
+            groups = {}
+            for ii, f in zip(indx, files):
+                groups.setdefault(ii // skip, []).append(f)
+                
+            files = [groups[ii // skip] for ii in indx[reduc]]
+            
+        else:
+            files = [files[ii] for ii in reduc]
+            
+        indx = indx[indx % skip == 0]
+        
+    return files, indx
+    
+def _get_files_indexed_(path, name):
+    """
+    Get the files sorted by name and their index normalized to 0, 1, 2... 
+    """
+    # File names and their numbers are taken from the manifest:
+    manifest = _get_manifest_(path)
+    
+    entries = sorted((v[0], x) for x, v in manifest['files'].items() if (name in x) and (v[0] is not None))
+    
+    files = [os.path.join(path, x) for ii, x in entries]
+    indx = numpy.array([ii for ii, x in entries], dtype = 'int64')
+    
+    if indx.size > 1:
+        indx //= (indx[1] - indx[0])
+        indx -= indx.min()
+        
+    return files, indx
+    
 def _get_files_sorted_(path, name):
     """
     Sort file entries using the natural (human) sorting
     """
-    # Get the files
-    files = os.listdir(path)
-    
-    # Get the files that are alike and sort:
-    files = [os.path.join(path,x) for x in files if (name in x)]
+    return _get_files_indexed_(path, name)[0]
 
-    # Keys
-    keys = [int(re.findall('\d+', f)[-1]) for f in files]
+def _get_manifest_(path, refresh = False):
+    """
+    Get the manifest of a directory: names of the files, their numbers, sizes and modification times. 
+    The manifest is kept in a sidecar file and in memory. It is validated using the modification time of the directory 
+    and updated incrementally: only new files are stat-ed. Use refresh = True to re-check all files.
+    """
+    import json
+    
+    path = os.path.abspath(path)
+    
+    mtime = os.stat(path).st_mtime_ns
+    
+    # Only the directory itself is locked during the file system access:
+    with _manifest_path_lock_(path):
+        
+        with _manifest_lock_:
+            manifest = _manifests_.get(path)
+        
+        # Try the sidecar file:
+        if manifest is None:
+            try:
+                with open(os.path.join(path, manifest_name), 'r') as f:
+                    manifest = json.load(f)
+                    
+            except (OSError, ValueError):
+                manifest = None
+        
+        if (manifest is not None) and (manifest.get('version') != 1):
+            manifest = None
+            
+        # Directory mtime has a coarse resolution on some filesystems. Don't trust it if it is too recent:
+        recent = (time.time() - mtime / 1e9) < 2
+        
+        if (manifest is not None) and (manifest['mtime'] == mtime) and not (refresh or recent):
+            with _manifest_lock_:
+                _manifests_[path] = manifest
+                
+            return manifest
+        
+        # Update the list of files:
+        old = manifest['files'] if (manifest and not refresh) else {}
+        files = {}
+        
+        for x in os.listdir(path):
+            
+            if x == manifest_name: continue
+            
+            if x in old:
+                files[x] = old[x]
+                continue
+            
+            st = os.stat(os.path.join(path, x))
+            
+            if not stat.S_ISREG(st.st_mode): continue
+        
+            digits = re.findall(r'\d+', x)
+            files[x] = [int(digits[-1]) if digits else None, st.st_size, st.st_mtime_ns]
+        
+        # Keep frame layouts of the files that didn't change:
+        frames = manifest.get('frames', {}) if manifest else {}
+        frames = {k: v for k, v in frames.items() if files.get(v['file']) == v['entry']}
+        
+        manifest = {'version': 1, 'mtime': mtime, 'files': files, 'frames': frames}
+        
+        _save_manifest_(path, manifest)
+        
+        with _manifest_lock_:
+            _manifests_[path] = manifest
+        
+    return manifest
 
-    # Sort files using keys:
-    files = [f for (k, f) in sorted(zip(keys, files))]
+def _manifest_path_lock_(path):
+    """
+    Lock of the manifest of a single directory (absolute path).
+    """
+    with _manifest_lock_:
+        return _manifest_locks_.setdefault(path, threading.RLock())
 
-    return files 
+def _catalog_record_(path, name, stamps):
+    """
+    Read the log file and the manifest of a scan folder and make a catalog record.
+    """
+    import json
+    import hashlib
+    
+    record = {'path': path, 'log_mtime': stamps[0], 'dir_mtime': stamps[1]}
+    
+    try:
+        meta = read_log(path, 'flexray')
+        
+        manifest = _get_manifest_(path)
+        
+    except Exception as e:
+        # Keep the error (whatever is wrong with the log): the folder is parsed again only when it changes.
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+        
+    # Creating the manifest sidecar changes the folder mtime:
+    try:
+        record['dir_mtime'] = os.stat(path).st_mtime_ns
+    except OSError:
+        pass
     
+    if record.get('error'): return record
     
+    record['frames'] = len(_get_files_indexed_(path, name)[0])
+    record['manifest'] = hashlib.sha1(json.dumps(sorted(manifest['files'].items())).encode()).hexdigest()
+    record['meta'] = json.dumps(meta, default = lambda x: numpy.asarray(x).tolist())
     
-
+    for key, record_type in _catalog_columns_.items():
+        value = meta[record_type].get(key)
+        
+        if isinstance(value, (list, tuple)): value = json.dumps(value)
+        if isinstance(value, numpy.generic): value = value.item()
+            
+        record[key] = value
+    
+    return record
+    
+def _save_manifest_(path, manifest):
+    """
+    Try to save the manifest next to the data. Read-only directories are fine - manifest stays in memory only.
+    """
+    import json
+    
+    filename = os.path.join(path, manifest_name)
+    
+    try:
+        created = not os.path.exists(filename)
+        
+        with open(filename, 'w') as f:
+            json.dump(manifest, f)
+            
+        # Creating the sidecar changes the directory mtime. Rewriting it in place doesn't.
+        if created:
+            manifest['mtime'] = os.stat(path).st_mtime_ns
+            
+            with open(filename, 'w') as f:
+                json.dump(manifest, f)
+                
+    except OSError:
+        pass
+    
+def _frame_layout_(path, name):
+    """
+    Get shape and dtype of the first file in a stack. Cached in the manifest and validated 
+    with the size and modification time of the file (files can be overwritten without changing the directory mtime).
+    """
+    path = os.path.abspath(path)
+    
+    manifest = _get_manifest_(path)
+    lock = _manifest_path_lock_(path)
+    
+    with lock:
+        frame = manifest['frames'].get(name)
+        
+    if frame is not None:
+        try:
+            st = os.stat(os.path.join(path, frame['file']))
+            
+            if list(frame['entry'][1:]) != [st.st_size, st.st_mtime_ns]: frame = None
+            
+        except OSError:
+            frame = None
+        
+    if frame is None:
+        files = _get_files_sorted_(path, name)
+        
+        if len(files) == 0: raise IOError('Files not found:', os.path.join(path, name))
+        
+        layout = _tiff_layout_(files[0])
+        file = os.path.basename(files[0])
+        st = os.stat(files[0])
+        
+        with lock:
+            # The manifest could have been rebuilt by _get_files_sorted_: store the frame in the current one.
+            manifest = _get_manifest_(path)
+            
+            entry = [manifest['files'][file][0], st.st_size, st.st_mtime_ns]
+            manifest['files'][file] = entry
+            
+            frame = {'file': file, 'entry': entry, 'shape': list(layout['shape']), 'dtype': layout['dtype'].str}
+            
+            manifest['frames'][name] = frame
+            _save_manifest_(path, manifest)
+            
+    return tuple(frame['shape']), numpy.dtype(frame['dtype'])
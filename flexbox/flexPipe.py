@@ -127,6 +127,11 @@ class Pipe:
 
         # Connection to other pipes:
         self._connections_ = []    
+        
+        # Background reading of the next block (see prefetch):
+        self._prefetch_ = None
+        self._prefetched_ = {}
+        self._pool_ = None
 
         # Memmaps - need to delete them at the end:
         self._memmaps_ = []    
@@ -168,6 +173,17 @@ class Pipe:
             myaction = Action(action.name, callback, action.conditions, action.type)
             self._action_que_.append(myaction)
                 
+    def prefetch(self, memory = None):
+        """
+        Read the next data block in a background thread while the current one is processed.
+        Only the read actions at the top of the action que are done in advance (read_flexray, process_flex, read_volume).
+        Blocks that are read into a memmap are not prefetched (they would share the memmap file).
+        
+        Args:
+            memory (float): maximum number of bytes a prefetched block can take (estimated from the current block)
+        """
+        self._prefetch_ = {'memory': memory}
+        
     def connect(self, pipe):
         """
         Connect to another pipe:copy()
@@ -198,6 +214,13 @@ class Pipe:
         
         # Buffer for the group actions:
         self._buffer_ = {}
+        
+        # Stop reading ahead:
+        if self._pool_:
+            self._pool_.shutdown()
+            self._pool_ = None
+            
+        self._prefetched_ = {}
 
         gc.collect()
         
@@ -336,8 +359,9 @@ class Pipe:
                     #print('*** Block ***')
                     #print(block.data)
                     
-                    # Apply action
-                    action.callback(self._block_, action.conditions, action.count)
+                    # Apply action (unless it was done in the background)
+                    if not self._wait_prefetch_(self._block_, action):
+                        action.callback(self._block_, action.conditions, action.count)
                     
                     # Collect garbage:
                     gc.collect() 
@@ -345,6 +369,9 @@ class Pipe:
                     # Make an end log record
                     self._block_.finish(action.name, action.conditions)
                     
+                    # When this block is read, start reading the next one:
+                    self._start_prefetch_(action)
+                    
             self._block_.status = 'ready'    
         
     def report(self):
@@ -387,6 +414,76 @@ class Pipe:
         """
         return all([(block.status == 'ready') for block in self._data_que_])
         
+    def _prefetch_actions_(self):
+        """
+        Read actions at the top of the action que that can be applied in advance.
+        """
+        actions = []
+        
+        for action in self._action_que_:
+            if (action.name not in ['read_flexray', 'process_flex', 'read_volume']) or action.conditions.get('memmap'):
+                break
+            
+            actions.append(action)
+        
+        return actions
+        
+    def _start_prefetch_(self, action):
+        """
+        Start reading the next pending block if the action is the last read action of the current one.
+        """
+        if not self._prefetch_: return
+        
+        actions = self._prefetch_actions_()
+        
+        if (not actions) or (action is not actions[-1]): return
+        
+        # Next block that is not read yet:
+        pending = [block for block in self._data_que_ if (block.status == 'pending') and (block is not self._block_) 
+                   and (block not in self._prefetched_)]
+        
+        if not pending: return
+        
+        # Assume that the next block is as big as this one:
+        memory = self._prefetch_.get('memory')
+        size = flexData._nbytes_([self._block_.data, self._block_.dark, self._block_.flat])
+        
+        if memory and (size > memory):
+            print('Next block is too big to prefetch.')
+            return
+        
+        block = pending[0]
+        
+        def read():
+            for action in actions:
+                action.callback(block, action.conditions, action.count)
+        
+        if not self._pool_:
+            from concurrent.futures import ThreadPoolExecutor
+            self._pool_ = ThreadPoolExecutor(max_workers = 1)
+            
+        print('Prefetching the next block:', block.path)
+        
+        self._prefetched_[block] = (self._pool_.submit(read), [action.name for action in actions])
+        
+    def _wait_prefetch_(self, block, action):
+        """
+        If the action was applied to the block in the background, wait for it to finish and return True.
+        """
+        if block not in self._prefetched_: return False
+        
+        future, names = self._prefetched_[block]
+        
+        if action.name not in names: return False
+        
+        # Errors of the background read are raised here:
+        future.result()
+        
+        if action.name == names[-1]:
+            self._prefetched_.pop(block)
+            
+        return True
+        
     def _pick_data_(self):
         """
         Pick data from the data pool
@@ -422,6 +519,15 @@ class Pipe:
         
         print('Reading all metadata...')
         
+        # Log files can be parsed in parallel through a catalog:
+        catalog = condition.get('catalog')
+        
+        if catalog and not condition.get('volume'):
+            paths = [data.path for data in self._data_que_]
+            flexData.update_catalog(catalog, paths, workers = condition.get('workers', 4))
+            
+            metas = flexData.query_catalog(catalog, paths = paths, bins = condition.get('sampling') or 1)
+            
         for data in self._data_que_:
             path = data.path
             samp = condition.get('sampling')
@@ -429,7 +535,11 @@ class Pipe:
             if condition.get('volume'):
                 data.meta = flexData.read_meta(os.path.join(path, 'meta.toml'))
                 
+            elif catalog and (os.path.abspath(path) in metas):
+                data.meta = metas[os.path.abspath(path)]
+                
             else:
+                # Folders that the catalog couldn't parse are read directly (read_log reports the actual error):
                 meta = flexData.read_log(path, 'flexray', bins = samp)
                 data.meta = meta
     
@@ -457,7 +567,7 @@ class Pipe:
     def _read_flexray_(self, data, condition, count):
         """
         Read data from disk.
-        Possible conditions: path, samplig, memmap
+        Possible conditions: path, samplig, memmap, workers, average
         """        
         
         # Read:    
@@ -468,10 +578,15 @@ class Pipe:
         samp = condition.get('sampling')
         skip = condition.get('skip')
         memmap = condition.get('memmap')
+        workers = condition.get('workers')
+        average = bool(condition.get('average'))
         
         if skip is None:
             skip = samp
             
+        if workers is None:
+            workers = 1
+            
         if memmap:
             self._memmaps_.append(memmap)
 
@@ -480,17 +595,18 @@ class Pipe:
         data.dark = None
         data.flat = None
             
-        # Read projections:                
-        data.dark = flexData.read_raw(path, 'di', sample = [samp, samp])
-        data.flat = flexData.read_raw(path, 'io', sample = [samp, samp])    
+        # Read projections directly in the ASTRA layout:                
+        data.dark = flexData.read_raw(path, 'di', sample = [samp, samp], workers = workers, average = average, layout = 'astra')
+        data.flat = flexData.read_raw(path, 'io', sample = [samp, samp], workers = workers, average = average, layout = 'astra')    
         
-        data.data = flexData.read_raw(path, 'scan_', skip = skip, sample = [samp, samp], memmap = memmap)
+        index = []
+        data.data = flexData.read_raw(path, 'scan_', skip = skip, sample = [samp, samp], memmap = memmap, workers = workers, 
+                                      average = average, layout = 'astra', index = index)
     
         data.meta = flexData.read_log(path, 'flexray', bins = samp)   
-                
-        data.data = flexData.raw2astra(data.data)    
-        data.dark = flexData.raw2astra(data.dark)    
-        data.flat = flexData.raw2astra(data.flat)    
+        
+        # Angles of the corrupted files are left out:
+        data.meta['geometry'] = flexData.set_thetas(data.meta['geometry'], index, skip)
         
         data.type = 'projections'
         
@@ -835,15 +951,19 @@ class Pipe:
             
                 elif crop > 0:
                     # Pad case:
-                    data.data = flexData.pad(data.data, dim, crop, symmetric = True)
+                    data.data = flexData.pad(data.data, dim, crop, symmetric = True, virtual = True)
+                    
+            # Pads and crops are applied in one go (unless the following actions can work with a view):
+            if isinstance(data.data, flexData.PaddedArray) and not condition.get('virtual'):
+                data.data = data.data.copy()
 
     def _bin_(self, data, condition, count):
         """
-        Crop the data.
+        Bin the data.
         """
-        print('Applying crop...')
+        print('Applying binning...')
         
-        data.data = flexData.bin(data.data)
+        data.data = flexData.bin(data.data, condition.get('factor', 2), workers = condition.get('workers', 1))
             
     def _crop_(self, data, condition, count):
         """
@@ -863,7 +983,7 @@ class Pipe:
         """        
         print('Casting data to int...')
         
-        data.data = flexData.cast2type(data.data, 'uint8', condition.get('bounds'))
+        data.data = flexData.cast2type(data.data, 'uint8', condition.get('bounds'), workers = condition.get('workers', 1))
                 
     def _display_(self, data, condition, count):
         """
@@ -912,6 +1032,7 @@ class Pipe:
         dim = condition.get('dim')
         name = condition.get('name')
         skip = condition.get('skip')
+        pyramid = condition.get('pyramid')
         
         if name is None:
             name = 'vol'
@@ -922,7 +1043,7 @@ class Pipe:
         if skip is None:
             skip = 1
 
-        flexData.write_raw(os.path.join(data.path,  folder), name, data.data, dim = dim, skip = skip)
+        flexData.write_raw(os.path.join(data.path,  folder), name, data.data, dim = dim, skip = skip, pyramid = pyramid)
         flexData.write_meta(os.path.join(data.path, folder, 'meta.toml'), data.meta)  
         
     def _shift_(self, data, condition, count):
@@ -1056,14 +1177,18 @@ class Pipe:
                 crop = shp_max[dim] - myshape[dim]
                 if crop < 0:
                     # Crop case:
-                    data.data = flexUtil.crop(data.data, dim, -crop, symmetric = True)
+                    data.data = flexData.crop(data.data, dim, -crop, symmetric = True)
             
                 elif crop > 0:
                     # Pad case:
-                    data.data = flexUtil.pad(data.data, dim, crop, symmetric = True)
+                    data.data = flexData.pad(data.data, dim, crop, symmetric = True, virtual = True)
+                    
+            # Pads and crops are applied in one go (unless the following actions can work with a view):
+            if isinstance(data.data, flexData.PaddedArray) and not condition.get('virtual'):
+                data.data = data.data.copy()
             
-        # Report:
-        mass = numpy.sum(data.data > 0) / numpy.prod(data.data.shape)    
+        # Report (slice by slice, data can be a view):
+        mass = sum(numpy.count_nonzero(data.data[ii] > 0) for ii in range(data.data.shape[0])) / numpy.prod(data.data.shape)    
         print('Nonzero pixels: %0.3f of the volume.' % mass)
             
         # Last call:   
@@ -19,12 +19,96 @@ from . import flexUtil
 from . import flexData
 from . import flexModel
 
+''' * Globals * '''
+
+# Projector backend used by all projection and reconstruction functions (see set_backend):
+_backend_ = {'name': 'astra_cuda', 'workers': None}
+
+# Memory budget (bytes) for the blocks of data passed to the projectors (see set_block_memory):
+_blocks_ = {'memory': None}
+
 ''' * Methods * '''
 
+def set_backend(backend = 'astra_cuda', workers = None):
+    """
+    Select the projector backend used by all projection and reconstruction functions.
+    
+    Args:
+        backend (str): 'astra_cuda' - ASTRA GPU projectors, 'cpu' - multi-threaded NumPy projectors (no CUDA needed, but much slower)
+        workers (int): number of threads used by the cpu backend (default - number of CPUs)
+    """
+    if backend not in ['astra_cuda', 'cpu']: raise ValueError('Unknown backend: ' + str(backend))
+    
+    _backend_['name'] = backend
+    _backend_['workers'] = workers
+
+def set_block_memory(memory = None):
+    """
+    Set the memory budget for the blocks of data that are passed to the projectors by backproject, forwardproject, SIRT and EM.
+    Arrays that are processed block by block (memmaps, stacks on disk, views) are split into as few blocks as fit the budget.
+    
+    Args:
+        memory (int): budget in bytes (default - a quarter of the free RAM at the time of the call). Reduce it if the GPU memory is the limit.
+    """
+    _blocks_['memory'] = memory
+    
+def _block_memory_():
+    """
+    Current memory budget for the blocks in bytes.
+    """
+    import os
+    
+    if _blocks_['memory'] is not None:
+        return _blocks_['memory']
+    
+    try:
+        free = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        free = 4 * 1024**3
+        
+    return max(free // 4, 64 * 1024**2)
+    
+def _block_count_(length, item_bytes, block_number = 1, fixed_bytes = 0):
+    """
+    Number of blocks to split length items into: at least block_number and enough for every block to fit the memory budget.
+    
+    Args:
+        length (int): number of items (angles or slices)
+        item_bytes (int): memory needed per item in a block
+        block_number (int): minimal number of blocks
+        fixed_bytes (int): memory needed independently of the block size
+    """
+    budget = _block_memory_() - fixed_bytes
+    
+    # At least one item per block even if the budget is too small:
+    fit = max(1, int(budget // max(1, item_bytes)))
+    
+    return int(min(length, max(block_number, numpy.ceil(length / fit))))
+    
+def _block_slices_(length, block_number):
+    """
+    First and last (exclusive) index of blocks of nearly equal size that cover the whole range of length.
+    """
+    bounds = (numpy.arange(block_number + 1) * length) // block_number
+    
+    return [(int(bounds[ii]), int(bounds[ii + 1])) for ii in range(block_number) if bounds[ii + 1] > bounds[ii]]
+
+def _blockwise_(array):
+    """
+    Check if the array has to be processed block by block: it is on disk (memmap, TiffStack), is a view (PaddedArray) 
+    or is not stored as float32.
+    """
+    if isinstance(array, (numpy.memmap, flexData.TiffStack, flexData.ScaledArray, flexData.PaddedArray)):
+        return True
+    
+    return array.dtype != numpy.float32
+            
 def _backproject_block_(projections, volume, proj_geom, vol_geom, algorithm = 'BP3D_CUDA', operation = '+'):
     """
     Use this internal function to compute backprojection of a single block of data.
     """           
+    if _backend_['name'] == 'cpu':
+        return _cpu_backproject_block_(projections, volume, proj_geom, vol_geom, algorithm, operation)
     
     # Unfortunately need to hide the experimental ASTRA
     import astra.experimental as asex 
@@ -91,6 +175,9 @@ def _forwardproject_block_(projections, volume, proj_geom, vol_geom, operation =
     """
     Use this internal function to compute backprojection of a single block of data.
     """           
+    if _backend_['name'] == 'cpu':
+        return _cpu_forwardproject_block_(projections, volume, proj_geom, vol_geom, operation)
+    
     # Unfortunately need to hide the experimental ASTRA
     import astra.experimental as asex 
     
@@ -126,12 +213,592 @@ def _forwardproject_block_(projections, volume, proj_geom, vol_geom, operation =
         astra.data3d.delete(sin_id)
         astra.data3d.delete(vol_id)            
             
+def _cpu_backproject_block_(projections, volume, proj_geom, vol_geom, algorithm = 'BP3D_CUDA', operation = '+'):
+    """
+    Same as _backproject_block_ using the cpu backend.
+    """
+    if algorithm not in ['BP3D_CUDA', 'FDK_CUDA']: raise ValueError('Unknown ASTRA algorithm type.')
+    
+    fdk = (algorithm == 'FDK_CUDA')
+    
+    if (operation == '+'):
+        volume += _cpu_backproject_(projections, proj_geom, vol_geom, fdk)
+        
+    elif (operation == '*'):
+        volume *= _cpu_backproject_(projections, proj_geom, vol_geom, fdk)
+        
+        # Normalize by the backprojection of ones (needed in case of overlap for EM):
+        norm = _cpu_backproject_(numpy.ones(projections.shape, dtype = 'float32'), proj_geom, vol_geom, fdk)
+        norm[norm < 0.01] = 0.01
+        
+        volume /= norm
+        
+    elif (operation == '/'):
+        volume_ = _cpu_backproject_(projections, proj_geom, vol_geom, fdk)
+        volume_[volume_ < 1e-3] = numpy.inf
+        
+        volume /= volume_
+        
+    else: raise ValueError('Unknown operation type!')
+    
+def _cpu_forwardproject_block_(projections, volume, proj_geom, vol_geom, operation = '+'):
+    """
+    Same as _forwardproject_block_ using the cpu backend.
+    """
+    projections_ = _cpu_forwardproject_(volume, proj_geom, vol_geom)
+    
+    if (operation == '+'):
+        projections += projections_
+        
+    elif (operation == '*'):
+        projections *= projections_
+        
+    elif (operation == '/'):
+        projections_[projections_ < 1e-10] = numpy.inf        
+        projections /= projections_
+        
+    else: raise ValueError('Unknown operation type!')
+    
+def _cpu_map_(function, items):
+    """
+    Apply the function to all items using the threads of the cpu backend.
+    """
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+    
+    workers = _backend_['workers'] or os.cpu_count() or 1
+    
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        return list(pool.map(function, items))
+    
+def _cpu_grid_(vol_geom):
+    """
+    Shape [z, y, x], lower corner [x, y, z] and voxel size [x, y, z] of an ASTRA volume geometry.
+    """
+    opt = vol_geom['option']
+    
+    shape = (int(vol_geom['GridSliceCount']), int(vol_geom['GridRowCount']), int(vol_geom['GridColCount']))
+    
+    low = numpy.array([opt['WindowMinX'], opt['WindowMinY'], opt['WindowMinZ']], dtype = 'float64')
+    high = numpy.array([opt['WindowMaxX'], opt['WindowMaxY'], opt['WindowMaxZ']], dtype = 'float64')
+    
+    return shape, low, (high - low) / numpy.array(shape[::-1])
+    
+def _cpu_forwardproject_(volume, proj_geom, vol_geom):
+    """
+    Ray-driven cone beam forward projection: line integrals (in units of the geometry, e.g. mm) sampled 
+    with trilinear interpolation at half-voxel steps. Uses the same cone_vec vectors as ASTRA.
+    Samples are taken at fixed distances from the source and interpolation is linear in the voxel values, 
+    so forward projections of the slabs of a volume add up to the projection of the whole volume.
+    """
+    from scipy import ndimage
+    
+    vectors = numpy.array(proj_geom['Vectors'], dtype = 'float64')
+    rows, cols = int(proj_geom['DetectorRowCount']), int(proj_geom['DetectorColCount'])
+    
+    shape, low, voxel = _cpu_grid_(vol_geom)
+    high = low + voxel * numpy.array(shape[::-1])
+    
+    # Samples within half a voxel from the edge are interpolated with the zeros outside. Keep them (with a one voxel halo): 
+    # the neighbouring slab has the other part of the interpolated value.
+    box_low = low - voxel
+    box_high = high + voxel
+    
+    volume = numpy.ascontiguousarray(volume, dtype = 'float32')
+    projections = numpy.zeros((rows, len(vectors), cols), dtype = 'float32')
+    
+    step = voxel.min() / 2
+    
+    def project(ii):
+        
+        src, det, u, v = vectors[ii].reshape(4, 3)
+        
+        # Unit rays from the source to the centres of detector pixels:
+        r = numpy.arange(rows) - rows / 2 + 0.5
+        c = numpy.arange(cols) - cols / 2 + 0.5
+        
+        rays = det + r[:, None, None] * v + c[None, :, None] * u - src
+        rays /= numpy.sqrt((rays ** 2).sum(-1))[..., None]
+        
+        # Distances at which the rays enter and leave the volume:
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            t0 = (box_low - src) / rays
+            t1 = (box_high - src) / rays
+            
+        t_in = numpy.maximum(numpy.nanmax(numpy.minimum(t0, t1), -1), 0)
+        t_out = numpy.nanmin(numpy.maximum(t0, t1), -1)
+        
+        hit = t_out > t_in
+        if not hit.any(): return
+        
+        # Samples are at (k + 0.5) * step from the source, starting in front of the box:
+        first = numpy.floor(t_in / step)
+        first[~hit] = 0
+        
+        count = int(numpy.ceil((t_out - first * step)[hit].max() / step))
+        samples = numpy.arange(count) + 0.5
+        
+        # Blocks of detector rows with about 10^6 samples:
+        block = max(1, int(2**20 // max(1, cols * count)))
+        
+        for r0 in range(0, rows, block):
+            
+            t = (first[r0:r0 + block, :, None] + samples) * step
+            points = src + rays[r0:r0 + block, :, None, :] * t[..., None]
+            
+            # World coordinates to [z, y, x] voxel indexes:
+            index = ((points - low) / voxel - 0.5)[..., ::-1].reshape(-1, 3).T
+            
+            values = ndimage.map_coordinates(volume, index, order = 1, mode = 'grid-constant').reshape(t.shape)
+            values[(t > t_out[r0:r0 + block, :, None]) | ~hit[r0:r0 + block, :, None]] = 0
+            
+            projections[r0:r0 + block, ii, :] = values.sum(-1) * step
+            
+    _cpu_map_(project, range(len(vectors)))
+    
+    return projections
+    
+def _cpu_backproject_(projections, proj_geom, vol_geom, fdk = False):
+    """
+    Voxel-driven cone beam backprojection with bilinear interpolation on the detector. Uses the same cone_vec vectors as ASTRA.
+    If fdk is False the result is (approximately) the adjoint of _cpu_forwardproject_. If fdk is True, 
+    projections are weighted and ramp-filtered and the result is the FDK reconstruction (in units of 1 / geometry units).
+    """
+    from scipy import ndimage
+    
+    vectors = numpy.array(proj_geom['Vectors'], dtype = 'float64')
+    rows, cols = int(proj_geom['DetectorRowCount']), int(proj_geom['DetectorColCount'])
+    
+    shape, low, voxel = _cpu_grid_(vol_geom)
+    
+    projections = numpy.asarray(projections, dtype = 'float32')
+    
+    if fdk:
+        projections = _cpu_fdk_filter_(projections, vectors)
+        
+        # Angular step times the source distance = distance between neighbouring source positions:
+        if len(vectors) > 1:
+            spacing = numpy.sqrt((numpy.gradient(vectors[:, :3], axis = 0) ** 2).sum(1))
+        else:
+            print('WARNING! FDK needs at least two projections in a block.')
+            spacing = numpy.zeros(1)
+    
+    # Voxel centres:
+    x = low[0] + (numpy.arange(shape[2]) + 0.5) * voxel[0]
+    y = low[1] + (numpy.arange(shape[1]) + 0.5) * voxel[1]
+    z = low[2] + (numpy.arange(shape[0]) + 0.5) * voxel[2]
+    
+    volume = numpy.zeros(shape, dtype = 'float32')
+    
+    def backproject(z0):
+        
+        z1 = min(z0 + slab, shape[0])
+        
+        total = numpy.zeros((z1 - z0, shape[1], shape[2]), dtype = 'float32')
+        
+        for ii in range(len(vectors)):
+            
+            src, det, u, v = vectors[ii].reshape(4, 3)
+            normal = numpy.cross(u, v)
+            
+            # Rays from the source to the voxels:
+            wx = (x - src[0])[None, None, :]
+            wy = (y - src[1])[None, :, None]
+            wz = (z[z0:z1] - src[2])[:, None, None]
+            
+            denom = wx * normal[0] + wy * normal[1] + wz * normal[2]
+            
+            # Magnification at the voxel and its projection on the detector relative to the detector centre:
+            mag = numpy.dot(det - src, normal) / denom
+            
+            qx = src[0] - det[0] + mag * wx
+            qy = src[1] - det[1] + mag * wy
+            qz = src[2] - det[2] + mag * wz
+            
+            col = (qx * u[0] + qy * u[1] + qz * u[2]) / numpy.dot(u, u) + cols / 2 - 0.5
+            row = (qx * v[0] + qy * v[1] + qz * v[2]) / numpy.dot(v, v) + rows / 2 - 0.5
+            
+            values = ndimage.map_coordinates(projections[:, ii, :], [row.ravel(), col.ravel()], order = 1, mode = 'grid-constant')
+            values = values.reshape(total.shape)
+            
+            if fdk:
+                # FDK weight: 1/2 * d_beta * (source to axis / source to voxel along the central ray)^2 
+                values *= 0.5 * spacing[ii] * mag ** 2 / abs(numpy.dot(det - src, normal) / numpy.sqrt(numpy.dot(normal, normal)))
+                
+            else:
+                # Adjoint weight: voxel volume / cross-section of the ray through the pixel at the voxel
+                length = numpy.sqrt(wx ** 2 + wy ** 2 + wz ** 2) * numpy.sqrt(numpy.dot(normal, normal))
+                values *= numpy.prod(voxel) * mag ** 2 * length / (abs(denom) * numpy.sqrt(numpy.dot(normal, normal)))
+                
+            total += values
+            
+        volume[z0:z1] = total
+        
+    # Slabs of about 10^6 voxels:
+    slab = max(1, int(2**20 // (shape[1] * shape[2])))
+    
+    _cpu_map_(backproject, range(0, shape[0], slab))
+    
+    return volume
+    
+def _cpu_fdk_filter_(projections, vectors):
+    """
+    FDK cosine weighting and ramp filtering of the detector rows.
+    """
+    rows, count, cols = projections.shape
+    
+    # Ram-Lak filter in the frequency domain (per unit of the pixel size):
+    n = 2 ** int(numpy.ceil(numpy.log2(2 * cols)))
+    
+    k = numpy.arange(n)
+    k[k > n // 2] -= n
+    
+    kernel = numpy.zeros(n)
+    kernel[0] = 0.25
+    kernel[k % 2 == 1] = -1 / (numpy.pi * k[k % 2 == 1]) ** 2
+    
+    ramp = numpy.real(numpy.fft.fft(kernel))
+    
+    filtered = numpy.zeros(projections.shape, dtype = 'float32')
+    
+    r = numpy.arange(rows) - rows / 2 + 0.5
+    c = numpy.arange(cols) - cols / 2 + 0.5
+    
+    def filter_one(ii):
+        
+        src, det, u, v = vectors[ii].reshape(4, 3)
+        
+        normal = numpy.cross(u, v)
+        normal /= numpy.sqrt(numpy.dot(normal, normal))
+        
+        # Cosine of the angle between the ray and the detector normal:
+        rays = det + r[:, None, None] * v + c[None, :, None] * u - src
+        cosine = abs(numpy.dot(det - src, normal)) / numpy.sqrt((rays ** 2).sum(-1))
+        
+        image = numpy.fft.fft(projections[:, ii, :] * cosine, n, axis = 1)
+        image = numpy.real(numpy.fft.ifft(image * ramp, axis = 1))[:, :cols]
+        
+        filtered[:, ii, :] = image / numpy.sqrt(numpy.dot(u, u))
+        
+    _cpu_map_(filter_one, range(count))
+    
+    return filtered
+    
+def _fdk_scale_(geometry):
+    """
+    ASTRA FDK needs to be divided by img_pixel^4 to get the attenuation per unit length. The cpu FDK doesn't.
+    """
+    if _backend_['name'] == 'cpu':
+        return 1
+    
+    return geometry['img_pixel'] ** 4
+    
+def _prj_weight_(geometry, count, volume_shape):
+    """
+    Quick and dirty scaling coefficient of the backprojection in SIRT instead of proper calculation of weights.
+    """
+    if _backend_['name'] == 'cpu':
+        return 1 / (count * geometry['img_pixel'] ** 2 * max(volume_shape))
+    
+    return 1 / (count * geometry['img_pixel'] ** 4 * max(volume_shape))
+    
+class ProjectionContext:
+    """
+    Projectors of an iterative reconstruction that are created once per block of projections and kept for all iterations.
+    EM sensitivities of the blocks are cached in the cache folder or in RAM (within the memory budget, see set_block_memory).
+    Use it as a context manager (or call close()) to release the projectors and the cache:
+    
+        with ProjectionContext(volume, geometry, projections.shape) as context:
+            synth = context.forward(index)
+            context.backward(index, residual)
+            
+    Projector (see _AstraProjector_ and _CpuProjector_) should implement create, forward, backward and delete.
+    """
+    
+    # Maximum number of blocks with a projector (matters for the random indexing only):
+    max_blocks = 256
+    
+    def __init__(self, volume, geometry, proj_shape, projector = None, cache = None):
+        """
+        Args:
+            volume (numpy.array): contiguous float32 volume that is updated in place
+            geometry: geometry record
+            proj_shape (tuple): shape of the complete projection data
+            projector: projector implementation (default - the one of the current backend, see set_backend)
+            cache (str): folder for the memmaps with sensitivities (default - keep them in RAM within the memory budget)
+        """
+        if not (isinstance(volume, numpy.ndarray) and (volume.dtype == numpy.float32) and volume.flags['C_CONTIGUOUS']):
+            raise ValueError('ProjectionContext needs a contiguous float32 volume.')
+        
+        if projector is None:
+            projector = _CpuProjector_() if _backend_['name'] == 'cpu' else _AstraProjector_()
+            
+        self.volume = volume
+        self.geometry = geometry
+        self.proj_shape = tuple(int(x) for x in proj_shape)
+        self.projector = projector
+        
+        self.vol_geom = flexData.astra_vol_geom(geometry, volume.shape)
+        
+        # Volume sized buffer for '*' and '/' backprojections (created when needed):
+        self._temp_ = None
+        
+        # Linked projection buffers (one per block shape) and handles ((block, target) -> handle):
+        self._buffers_ = {}
+        self._handles_ = {}
+        
+        # Sensitivities of the blocks (block -> volume) and their memmap files:
+        self.cache = cache
+        self._sensitivity_ = {}
+        self._files_ = []
+        
+        # RAM used by the cached sensitivities and the budget for them:
+        self._cached_bytes_ = 0
+        self._budget_ = _block_memory_()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+        
+    def close(self):
+        """
+        Release all projectors and buffers.
+        """
+        import os
+        
+        handles = list(self._handles_.values())
+        
+        self._handles_.clear()
+        self._buffers_.clear()
+        self._sensitivity_.clear()
+        self._cached_bytes_ = 0
+        self._temp_ = None
+        
+        for handle in handles:
+            self.projector.delete(handle)
+            
+        # Remove the memmaps of the cache:
+        for file in self._files_:
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+            
+        self._files_ = []
+            
+    def buffer(self, index):
+        """
+        Projection buffer linked to the block. It is shared by all blocks of the same size.
+        """
+        shape = (self.proj_shape[0], len(index), self.proj_shape[2])
+        
+        if shape not in self._buffers_:
+            self._buffers_[shape] = numpy.zeros(shape, dtype = 'float32')
+            
+        return self._buffers_[shape]
+        
+    def forward(self, index):
+        """
+        Forward projection of the volume for a block of angles. Result is stored in the linked buffer 
+        (it is overwritten by the next call, copy it if it needs to be kept).
+        """
+        handle, buffer = self._handle_(index, 'volume')
+        
+        buffer[:] = 0
+        self.projector.forward(handle)
+        
+        return buffer
+    
+    def backward(self, index, projections, algorithm = 'BP3D_CUDA', operation = '+', cache = True):
+        """
+        Backproject a block of angles and add ('+'), multiply ('*') or divide ('/') the volume by it.
+        Same as _backproject_block_. Multiplication is normalized by the sensitivity of the block: 
+        it is computed once if cache is True (use False if the block is not going to be used again).
+        """
+        if operation == '+':
+            handle, buffer = self._handle_(index, 'volume')
+            
+            if projections is not buffer: buffer[:] = projections
+            self.projector.backward(handle, algorithm)
+            
+            return
+        
+        if operation not in ['*', '/']: raise ValueError('Unknown operation type!')
+        
+        if self._temp_ is None:
+            self._temp_ = numpy.zeros_like(self.volume)
+            
+        handle, buffer = self._handle_(index, 'temp')
+        
+        temp = self._temp_
+        temp[:] = 0
+        
+        if projections is not buffer: buffer[:] = projections
+        self.projector.backward(handle, algorithm)
+        
+        if (operation == '*'):
+            
+            self.volume *= temp
+            
+            # Normalize by the backprojection of ones (needed in case of overlap for EM):
+            self.volume /= self.sensitivity(index, algorithm, cache)
+            
+        else:
+            temp[temp < 1e-3] = numpy.inf
+            self.volume /= temp
+            
+    def sensitivity(self, index, algorithm = 'BP3D_CUDA', cache = True):
+        """
+        Backprojection of ones for a block of angles (values below 0.01 are set to 0.01). 
+        If cache is True, it is computed only once and kept in a memmap in the cache folder or in RAM 
+        if it fits the memory budget (otherwise it is computed again at every call).
+        """
+        import os
+        import tempfile
+        
+        key = (numpy.asarray(index).tobytes(), algorithm)
+        
+        if key in self._sensitivity_:
+            return self._sensitivity_[key]
+        
+        if self._temp_ is None:
+            self._temp_ = numpy.zeros_like(self.volume)
+        
+        handle, buffer = self._handle_(index, 'temp')
+        
+        temp = self._temp_
+        temp[:] = 0
+        buffer[:] = 1
+        
+        self.projector.backward(handle, algorithm)
+        temp[temp < 0.01] = 0.01
+        
+        if not cache:
+            return temp
+        
+        if self.cache is None:
+            
+            # Volumes that don't fit the memory budget are not kept:
+            if self._cached_bytes_ + temp.nbytes > self._budget_:
+                return temp
+            
+            self._cached_bytes_ += temp.nbytes
+            sensitivity = temp.copy()
+            
+        else:
+            file, path = tempfile.mkstemp(suffix = '.sensitivity', dir = self.cache)
+            os.close(file)
+            self._files_.append(path)
+            
+            sensitivity = numpy.memmap(path, dtype = 'float32', mode = 'w+', shape = temp.shape)
+            sensitivity[:] = temp
+            sensitivity.flush()
+            
+        self._sensitivity_[key] = sensitivity
+        
+        return sensitivity
+    
+    def _handle_(self, index, target):
+        """
+        Get (or create) the projector handle of a block for the volume or the temporary volume.
+        """
+        index = numpy.asarray(index)
+        key = (index.tobytes(), target)
+        
+        buffer = self.buffer(index)
+        
+        handle = self._handles_.get(key)
+        
+        if handle is None:
+            
+            # Keep the number of projectors limited:
+            if len(self._handles_) >= self.max_blocks:
+                self.projector.delete(self._handles_.pop(next(iter(self._handles_))))
+            
+            proj_geom = flexData.astra_proj_geom(self.geometry, self.proj_shape, index = index)
+            volume = self.volume if target == 'volume' else self._temp_
+            
+            handle = self.projector.create(proj_geom, self.vol_geom, buffer, volume)
+            self._handles_[key] = handle
+            
+        return handle, buffer
+
+class _AstraProjector_:
+    """
+    ASTRA CUDA projector for ProjectionContext.
+    """
+    
+    def create(self, proj_geom, vol_geom, projections, volume):
+        
+        sin_id = astra.data3d.link('-sino', proj_geom, projections)        
+        vol_id = astra.data3d.link('-vol', vol_geom, volume)    
+        
+        projector_id = astra.create_projector('cuda3d', proj_geom, vol_geom)
+        
+        return projector_id, sin_id, vol_id
+    
+    def forward(self, handle):
+        
+        # Unfortunately need to hide the experimental ASTRA
+        import astra.experimental as asex 
+        
+        projector_id, sin_id, vol_id = handle
+        asex.accumulate_FP(projector_id, vol_id, sin_id)
+        
+    def backward(self, handle, algorithm = 'BP3D_CUDA'):
+        
+        import astra.experimental as asex 
+        
+        projector_id, sin_id, vol_id = handle
+        
+        if algorithm == 'BP3D_CUDA':
+            asex.accumulate_BP(projector_id, vol_id, sin_id)
+            
+        elif algorithm == 'FDK_CUDA':
+            asex.accumulate_FDK(projector_id, vol_id, sin_id)
+            
+        else:
+            raise ValueError('Unknown ASTRA algorithm type.')
+            
+    def delete(self, handle):
+        
+        projector_id, sin_id, vol_id = handle
+        
+        astra.projector3d.delete(projector_id)
+        astra.data3d.delete(sin_id)
+        astra.data3d.delete(vol_id)
+        
+class _CpuProjector_:
+    """
+    Projector of the cpu backend for ProjectionContext.
+    """
+    
+    def create(self, proj_geom, vol_geom, projections, volume):
+        return proj_geom, vol_geom, projections, volume
+    
+    def forward(self, handle):
+        
+        proj_geom, vol_geom, projections, volume = handle
+        projections += _cpu_forwardproject_(volume, proj_geom, vol_geom)
+        
+    def backward(self, handle, algorithm = 'BP3D_CUDA'):
+        
+        if algorithm not in ['BP3D_CUDA', 'FDK_CUDA']: raise ValueError('Unknown ASTRA algorithm type.')
+        
+        proj_geom, vol_geom, projections, volume = handle
+        volume += _cpu_backproject_(projections, proj_geom, vol_geom, algorithm == 'FDK_CUDA')
+        
+    def delete(self, handle):
+        pass
+    
 def backproject(projections, volume, geometry, algorithm = 'BP3D_CUDA', operation = '+'):
     """
     Backproject useing standard ASTRA functionality
     """
-    # If the data is not memmap:        
-    if not isinstance(projections, numpy.memmap):    
+    # If the data is not memmap (or a virtual stack on disk, or not float32):        
+    if not _blockwise_(projections):    
         
         projections = numpy.ascontiguousarray(projections) 
         
@@ -142,33 +809,37 @@ def backproject(projections, volume, geometry, algorithm = 'BP3D_CUDA', operatio
         _backproject_block_(projections, volume, proj_geom, vol_geom, algorithm, operation)
         
     else:
-        # Decide on the size of the block:
-        n = projections.shape[1]    
-        l = n // 10
+        # Decide on the size of the block (block, its float32 copy and the next block, volume sized buffer for '*' and '/'):
+        n = projections.shape[1]
+        item = projections.shape[0] * projections.shape[2] * 4 * 3
+        fixed = volume.size * 4 * (operation != '+')
         
         # Initialize ASTRA geometries:
         vol_geom = flexData.astra_vol_geom(geometry, volume.shape)
         
-        # Loop over blocks:
-        for ii in range(n // l):
-            
-            i0 = (ii * l)
-            i1 = min((ii * l + l), n+1)
+        def load(bounds):
             
             # Extract a block:
+            i0, i1 = bounds
             proj_geom = flexData.astra_proj_geom(geometry, projections.shape, numpy.arange(i0, i1))    
             
-            block = numpy.ascontiguousarray(projections[:, i0:i1,:])
+            return numpy.ascontiguousarray(projections[:, i0:i1,:], dtype = 'float32'), proj_geom
+        
+        # Loop over blocks (the next block is loaded in the background):
+        for block, proj_geom in flexData.prefetch(load, _block_slices_(n, _block_count_(n, item, fixed_bytes = fixed))):
             
             # Backproject:    
             _backproject_block_(block, volume, proj_geom, vol_geom, algorithm, operation)  
             
+            # Release the block before the next one is loaded:
+            block = None
+            
 def forwardproject(projections, volume, geometry, operation = '+'):
     """
     Forwardproject
     """
-    # If the data is not memmap:        
-    if not isinstance(volume, numpy.memmap):   
+    # If the volume is not memmap (or a view, or not float32):        
+    if not _blockwise_(volume):   
         
         # Initialize ASTRA geometries:
         vol_geom = flexData.astra_vol_geom(geometry, volume.shape)
@@ -178,26 +849,44 @@ def forwardproject(projections, volume, geometry, operation = '+'):
         
     else:
         
-        # Decide on the size of the block:
+        # Decide on the size of the block (block, its float32 copy and the next block):
         n = volume.shape[0]    
-        l = n // 10
+        item = volume.shape[1] * volume.shape[2] * 4 * 3
+        
+        # Projections of all blocks add up, '*' and '/' are applied to the sum:
+        if operation == '+':
+            projections_ = projections
+            fixed = 0
+        else:
+            projections_ = numpy.zeros(projections.shape, dtype = 'float32')
+            fixed = projections_.nbytes
         
         # Initialize ASTRA geometries:
         proj_geom = flexData.astra_proj_geom(geometry, projections.shape)    
         
-        # Loop over blocks:
-        for ii in range(n // l):
+        def load(bounds):
             
-            i0 = (ii * l)
-            i1 = min((ii * l + l), n+1)
+            # Extract a block (slices i0 to i1 - 1):
+            i0, i1 = bounds
+            vol_geom = flexData.astra_vol_geom(geometry, volume.shape, i0, i1 - 1)
             
-            # Extract a block:
-            vol_geom = flexData.astra_vol_geom(geometry, volume.shape, i0, i1)
+            return numpy.ascontiguousarray(volume[i0:i1, :, :], dtype = 'float32'), vol_geom
+        
+        # Loop over blocks (the next block is loaded in the background):
+        for block, vol_geom in flexData.prefetch(load, _block_slices_(n, _block_count_(n, item, fixed_bytes = fixed))):
             
-            block = numpy.ascontiguousarray(projections[i0:i1, :, :])
-
             # Forwardproject:
-            _forwardproject_block_(block, volume, proj_geom, vol_geom, operation)  
+            _forwardproject_block_(projections_, block, proj_geom, vol_geom, '+')  
+            
+            # Release the block before the next one is loaded:
+            block = None
+            
+        if (operation == '*'):
+            projections *= projections_
+            
+        elif (operation == '/'):
+            projections_[projections_ < 1e-10] = numpy.inf        
+            projections /= projections_
                      
 def init_volume(projections):
     """
@@ -224,7 +913,7 @@ def sample_FDK(projections, geometry, sample):
     _backproject_block_(projections_, volume, proj_geom, vol_geom, 'FDK_CUDA')
     
     # Apply correct scaling:
-    volume /= geometry['img_pixel']**4     
+    volume /= _fdk_scale_(geometry)
     
     return volume
     
@@ -237,7 +926,7 @@ def FDK(projections, volume, geometry):
     # Make sure array is contiguous (if not memmap):
     flexUtil.progress_bar(0)    
     
-    backproject(projections / geometry['img_pixel']**4, volume, geometry, 'FDK_CUDA')
+    backproject(projections / _fdk_scale_(geometry), volume, geometry, 'FDK_CUDA')
     
     flexUtil.progress_bar(1) 
     
@@ -246,8 +935,7 @@ def _block_index_(ii, block_number, length, mode = 'sequential'):
     Create a slice for a projection block
     """   
     
-    # Length of the block and the global index:
-    block_length = int(numpy.round(length / block_number))
+    # Global index:
     index = numpy.arange(length)
 
     # Different indexing modes:    
@@ -262,20 +950,65 @@ def _block_index_(ii, block_number, length, mode = 'sequential'):
     elif mode == 'equidistant':   
         
         # Index = 0, 2, 1, 3   
-        index = numpy.mod(numpy.arange(length) * block_length, length)
+        return index[ii::block_number]
         
     else:
         raise ValueError('Indexer type not recognized! Use: sequential/random/equidistant')
     
-    first = ii * block_length
-    last = min((length + 1, (ii + 1) * block_length))
+    # Blocks of nearly equal size that cover all indexes:
+    first = (ii * length) // block_number
+    last = ((ii + 1) * length) // block_number
     
     return index[first:last]
     
-def _L2_step_(projections, prj_weight, volume, geometry, options, operation = '+'):
+def _projection_blocks_(projections, block_number, mode, copy = True, positive = False, poisson = False):
+    """
+    Iterate over blocks of projections: (index, block, weight). The next block is gathered, converted
+    to float32 and weighted in a background thread while the current one is used: at most two blocks are in memory.
+    
+    Args:
+        projections: projection data
+        block_number (int): number of blocks
+        mode (str): indexing mode of _block_index_
+        copy (bool): copy the data if it is a single block (otherwise it's passed as it is)
+        positive (bool): set negative values in the blocks to zero
+        poisson (bool): compute Poisson weights of the blocks (otherwise weight is None)
+    """
+    length = projections.shape[1]
+    
+    def load(ii):
+        
+        # Create index slice to address projections:
+        index = _block_index_(ii, block_number, length, mode)
+        if len(index) == 0: return None
+        
+        # Copy data to a block or simply pass a pointer to data itself if block is one (and the data is a float32 array in RAM).
+        if (mode == 'sequential') & (block_number == 1) & (not _blockwise_(projections)):
+            block = projections.copy() if copy else projections
+            
+        else:
+            # Fancy indexing makes a copy, convert it to float32 if needed:
+            block = numpy.ascontiguousarray(projections[:, index, :], dtype = 'float32')
+            
+        # All blocks are clipped the same way:
+        if positive: block[block < 0] = 0
+        
+        # Some formula representing the effect of photon starvation...
+        weight = numpy.exp(-block) if poisson else None
+            
+        return index, block, weight
+    
+    for loaded in flexData.prefetch(load, range(block_number)):
+        if loaded is not None: 
+            yield loaded
+    
+def _L2_step_(projections, prj_weight, volume, geometry, options, operation = '+', context = None):
     """
-    Update volume: single SIRT step.
+    Update volume: single SIRT step. Pass a ProjectionContext to keep the projectors between the steps.
     """
+    if context is None:
+        with ProjectionContext(volume, geometry, projections.shape) as context:
+            return _L2_step_(projections, prj_weight, volume, geometry, options, operation, context)
     
     # CTF, mode of indexing:
     ctf = options.get('ctf')
@@ -285,56 +1018,32 @@ def _L2_step_(projections, prj_weight, volume, geometry, options, operation = '+
     block_number = options.get('block_number')
     if block_number is None: block_number = 1
     
-    # Force block number if array is numpy.memmap
-    if isinstance(projections, numpy.memmap):
-        block_number  = max((10, block_number))
-        
     length = projections.shape[1]
     
-    # Initialize ASTRA geometries:
-    vol_geom = flexData.astra_vol_geom(geometry, volume.shape)      
+    # Split arrays that are numpy.memmap (or a virtual stack on disk, or not float32) into blocks that fit the memory budget 
+    # (block, the buffer linked to the projector, forward projection, the weighted residual and the next block):
+    if _blockwise_(projections):
+        block_number = _block_count_(length, projections.shape[0] * projections.shape[2] * 4 * 5, block_number)
     
-    for ii in range(block_number):
-        
-        # Create index slice to address projections:
-        index = _block_index_(ii, block_number, length, mode)
-        if index is []: break
-
-        # Extract a block:
-        proj_geom = flexData.astra_proj_geom(geometry, projections.shape, index = index)    
-        
-        # Copy data to a block or simply pass a pointer to data itself if block is one.
-        if (mode == 'sequential') & (block_number == 1):
-            block = projections.copy()
-            
-        else:
-            block = (projections[:, index, :]).copy()
-            block = numpy.ascontiguousarray(block)
+    # The next block is loaded in the background:
+    blocks = _projection_blocks_(projections, block_number, mode, poisson = options.get('poisson_weight'))
+    
+    for index, block, weight in blocks:
                 
-        if ctf is None:
-            
-            # Forwardproject:
-            _forwardproject_block_(block, -volume, proj_geom, vol_geom, '+')   
-            
-        else:
-            
-            # Reserve memory for a forward projection (keep it separate because of CTF application):
-            synth = numpy.ascontiguousarray(numpy.zeros_like(block))
-  
-            # Forwardproject:
-            _forwardproject_block_(synth, volume, proj_geom, vol_geom, '+')   
-            
-            # CTF can be applied to each projection separately:
+        # Forwardproject (result is kept in the buffer of the context):
+        synth = context.forward(index)
+        
+        # CTF can be applied to each projection separately:
+        if ctf is not None:
             synth = flexModel.apply_ctf(synth, ctf)
 
-            # Compute residual:        
-            block = (block - synth)
+        # Compute residual:        
+        block -= synth
         
         # Take into account Poisson:
         if options.get('poisson_weight'):
-            # Some formula representing the effect of photon starvation...
-            #block *= numpy.sqrt(numpy.exp(-projections[:, index, :]))               
-            block *= numpy.exp(-projections[:, index, :])
+            #block *= numpy.sqrt(weight)               
+            block *= weight
             
         block *= prj_weight * block_number
         
@@ -349,7 +1058,10 @@ def _L2_step_(projections, prj_weight, volume, geometry, options, operation = '+
             l2 = 0 
           
         # Project
-        _backproject_block_(block, volume, proj_geom, vol_geom, 'BP3D_CUDA', operation)    
+        context.backward(index, block, 'BP3D_CUDA', operation)    
+        
+        # Release the block before the next one is loaded:
+        block = synth = weight = None
     
     # Apply bounds
     if options.get('bounds') is not None:
@@ -357,10 +1069,13 @@ def _L2_step_(projections, prj_weight, volume, geometry, options, operation = '+
 
     return l2   
 
-def _em_step_(projections, prj_weight, volume, geometry, options):
+def _em_step_(projections, prj_weight, volume, geometry, options, context = None):
     """
-    Update volume: single EM step.
+    Update volume: single EM step. Pass a ProjectionContext to keep the projectors between the steps.
     """
+    if context is None:
+        with ProjectionContext(volume, geometry, projections.shape) as context:
+            return _em_step_(projections, prj_weight, volume, geometry, options, context)
     
     # CTF, mode of indexing:
     ctf = options.get('ctf')
@@ -370,36 +1085,20 @@ def _em_step_(projections, prj_weight, volume, geometry, options):
     block_number = options.get('block_number')
     if block_number is None: block_number = 1
     
-    # Force block number if array is numpy.memmap
-    if isinstance(projections, numpy.memmap):
-        block_number  = max((10, block_number))
-        
     length = projections.shape[1]
     
-    # Initialize ASTRA geometries:
-    vol_geom = flexData.astra_vol_geom(geometry, volume.shape)      
+    # Split arrays that are numpy.memmap (or a virtual stack on disk, or not float32) into blocks that fit the memory budget 
+    # (block, the buffer linked to the projector, forward projection, the weighted residual and the next block):
+    if _blockwise_(projections):
+        block_number = _block_count_(length, projections.shape[0] * projections.shape[2] * 4 * 5, block_number)
     
-    for ii in range(block_number):
-        
-        # Create index slice to address projections:
-        index = _block_index_(ii, block_number, length, mode)
-        if index is []: break
-
-        # Extract a block:
-        proj_geom = flexData.astra_proj_geom(geometry, projections.shape, index = index)    
-        
-        # Copy data to a block or simply pass a pointer to data itself if block is one.
-        if (mode == 'sequential') & (block_number == 1):
-            block = projections
-            
-        else:
-            block = (projections[:, index, :]).copy()
-        
-        # Reserve memory for a forward projection (keep it separate):
-        synth = numpy.ascontiguousarray(numpy.zeros_like(block))
+    # The next block is loaded in the background:
+    blocks = _projection_blocks_(projections, block_number, mode, copy = False, positive = True)
+    
+    for index, block, weight in blocks:
         
-        # Forwardproject:
-        _forwardproject_block_(synth, volume, proj_geom, vol_geom, '+')   
+        # Forwardproject (result is kept in the buffer of the context):
+        synth = context.forward(index)
   
         # CTF can be applied to each projection separately:
         if ctf is not None:
@@ -419,7 +1118,11 @@ def _em_step_(projections, prj_weight, volume, geometry, options):
             l2 = [] 
           
         # Project
-        _backproject_block_(synth * prj_weight * block_number, volume, proj_geom, vol_geom, 'BP3D_CUDA', '*')    
+        # Sensitivities are reused in the next steps unless indexes of the blocks are random:
+        context.backward(index, synth * prj_weight, 'BP3D_CUDA', '*', cache = (mode != 'random'))    
+        
+        # Release the block before the next one is loaded:
+        block = synth = None
     
     # Apply bounds
     if options.get('bounds') is not None:
@@ -438,7 +1141,7 @@ def SIRT(projections, volume, geometry, iterations, options = {'poisson_weight':
     
     # We will use quick and dirty scaling coefficient instead of proper calculation of weights
     #m = (geometry['src2obj'] + geometry['det2obj']) / geometry['src2obj']
-    prj_weight = 1 / (projections.shape[1] * (geometry['img_pixel']) ** 4 * max(volume.shape)) 
+    prj_weight = _prj_weight_(geometry, projections.shape[1], volume.shape)
                     
     # Initialize L2:
     l2 = []
@@ -446,18 +1149,21 @@ def SIRT(projections, volume, geometry, iterations, options = {'poisson_weight':
     print('Doing SIRT`y things...')
     
     flexUtil.progress_bar(0)
-        
-    for ii in range(iterations):
     
-        # Update volume:
-        l2_  = _L2_step_(projections, prj_weight, volume, geometry, options)
-        l2.append(l2_)
-                    
-        # Preview
-        if options.get('preview'):
-            flexUtil.display_slice(volume, dim = 0)
-            
-        flexUtil.progress_bar((ii+1) / iterations)
+    # Projectors are created once for all iterations:
+    with ProjectionContext(volume, geometry, projections.shape) as context:
+        
+        for ii in range(iterations):
+        
+            # Update volume:
+            l2_  = _L2_step_(projections, prj_weight, volume, geometry, options, context = context)
+            l2.append(l2_)
+                        
+            # Preview
+            if options.get('preview'):
+                flexUtil.display_slice(volume, dim = 0)
+                
+            flexUtil.progress_bar((ii+1) / iterations)
         
     if options.get('l2_update'):   
 
@@ -480,37 +1186,42 @@ def SIRT_tiled(projections, volume, geometries, iterations, options = {'poisson_
     # In tiled reconstructions position of the volume should be the same for each tile:
     geometries_ = []
     for geom in geometries:
-        geom_ = geom.copy()
-        
         # Compute average volume shift:
-        geom_['vol_tra'] = numpy.mean([g['vol_tra'] for g in geometries], 0)
+        geom_ = flexData.copy_geometry(geom, vol_tra = numpy.mean([g['vol_tra'] for g in geometries], 0))
         geometries_.append(geom_)
 
     print('Doing SIRT`y things...')
     
     flexUtil.progress_bar(0)
         
-    for ii in range(iterations):
+    # Projectors are created once for all iterations:
+    contexts = [ProjectionContext(volume, geom, proj.shape) for geom, proj in zip(geometries_, projections)]
+    
+    try:
+        for ii in range(iterations):
         
-        l2_ = 0
-        for ii, proj in enumerate(projections):
+            l2_ = 0
+            for jj, proj in enumerate(projections):
             
-            geom = geometries_[ii]
+                geom = geometries_[jj]
 
-            #m = (geom['src2obj'] + geom['det2obj']) / geom['src2obj']
-            # This weight is half of the normal weight to make sure convergence is ok:
-            prj_weight = 1 / (proj.shape[1] * (geom['img_pixel']) ** 4 * max(volume.shape)) 
+                #m = (geom['src2obj'] + geom['det2obj']) / geom['src2obj']
+                # This weight is half of the normal weight to make sure convergence is ok:
+                prj_weight = _prj_weight_(geom, proj.shape[1], volume.shape)
     
-            # Update volume:
-            l2_ += _L2_step_(proj, prj_weight, volume, geom, options)
+                # Update volume:
+                l2_ += _L2_step_(proj, prj_weight, volume, geom, options, context = contexts[jj])
             
-        l2.append(l2_)
+            l2.append(l2_)
                     
-        # Preview
-        if options.get('preview'):
-            flexUtil.display_slice(volume, dim = 0)
+            # Preview
+            if options.get('preview'):
+                flexUtil.display_slice(volume, dim = 0)
             
-        flexUtil.progress_bar((ii+1) / iterations)
+            flexUtil.progress_bar((ii+1) / iterations)
+            
+    finally:
+        for context in contexts: context.close()
         
     if options.get('l2_update'):   
 
@@ -519,9 +1230,11 @@ def SIRT_tiled(projections, volume, geometries, iterations, options = {'poisson_
          plt.title('Residual L2')    
          
          
-def EM(projections, volume, geometry, iterations, options = {'preview':False, 'bounds':None, 'block_number':1, 'index':'sequential', 'l2_update': True}):
+def EM(projections, volume, geometry, iterations, options = {'preview':False, 'bounds':None, 'block_number':1, 'index':'sequential', 'l2_update': True, 'cache': None}):
     """
     Expectation Maximization
+    Sensitivity of every block is computed once: it is kept in RAM (within the memory budget, see set_block_memory) 
+    or, if options['cache'] is a folder, in memmaps in that folder.
     """ 
     # Make sure array is contiguous (if not memmap):
     #if not isinstance(projections, numpy.memmap):
@@ -533,7 +1246,9 @@ def EM(projections, volume, geometry, iterations, options = {'preview':False, 'b
         volume += 1
     elif volume.min() < 0: volume[volume < 0] = 0
 
-    projections[projections < 0] = 0
+    # Arrays that are not numpy arrays are made positive block by block:
+    if isinstance(projections, numpy.ndarray):
+        projections[projections < 0] = 0
 
     # Initialize L2:
     l2 = []
@@ -542,23 +1257,26 @@ def EM(projections, volume, geometry, iterations, options = {'preview':False, 'b
     
     flexUtil.progress_bar(0)
         
-    for ii in range(iterations):
+    # Projectors are created once for all iterations:
+    with ProjectionContext(volume, geometry, projections.shape, cache = options.get('cache')) as context:
+        
+        for ii in range(iterations):
 
-        # Temp projection data
-        #forwardproject(projections, volume, geometry, operation = '/')
+            # Temp projection data
+            #forwardproject(projections, volume, geometry, operation = '/')
                 
-        # Temp reconstruction volume        
-        #backproject(projections, volume, geometry, 'BP3D_CUDA', operation = '*')    
+            # Temp reconstruction volume        
+            #backproject(projections, volume, geometry, 'BP3D_CUDA', operation = '*')    
         
-        # Update volume:
-        l2_  = _em_step_(projections, 1, volume, geometry, options)
-        l2.append(l2_)
+            # Update volume:
+            l2_  = _em_step_(projections, 1, volume, geometry, options, context = context)
+            l2.append(l2_)
                     
-        # Preview
-        if options.get('preview'):
-            flexUtil.display_slice(volume, dim = 0)
+            # Preview
+            if options.get('preview'):
+                flexUtil.display_slice(volume, dim = 0)
                         
-        flexUtil.progress_bar((ii+1) / iterations)
+            flexUtil.progress_bar((ii+1) / iterations)
         
     if options.get('l2_update'):
 
@@ -566,9 +1284,11 @@ def EM(projections, volume, geometry, iterations, options = {'preview':False, 'b
          plt.plot(l2)
          plt.title('Residual L2')
 
-def EM_tiled(projections, volume, geometries, iterations, options = {'poisson_weight': False, 'l2_update': True, 'preview':False, 'bounds':None, 'block_number':1, 'index':'sequential', 'ctf': None}):
+def EM_tiled(projections, volume, geometries, iterations, options = {'poisson_weight': False, 'l2_update': True, 'preview':False, 'bounds':None, 'block_number':1, 'index':'sequential', 'ctf': None, 'cache': None}):
     """
     EM: tiled version.
+    Sensitivity of every block is computed once: it is kept in RAM (within the memory budget, see set_block_memory) 
+    or, if options['cache'] is a folder, in memmaps in that folder.
     """     
     # Make sure that the volume is positive:
     if volume.max() <= 0: 
@@ -577,7 +1297,8 @@ def EM_tiled(projections, volume, geometries, iterations, options = {'poisson_we
     elif volume.min() < 0: volume[volume < 0] = 0
 
     for proj in projections:
-        proj[proj < 0] = 0
+        if isinstance(proj, numpy.ndarray):
+            proj[proj < 0] = 0
 
     # Initialize L2:
     l2 = []
@@ -585,33 +1306,38 @@ def EM_tiled(projections, volume, geometries, iterations, options = {'poisson_we
     # In tiled reconstructions position of the volume should be the same for each tile:
     geometries_ = []
     for geom in geometries:
-        geom_ = geom.copy()
-        
         # Compute average volume shift:
-        geom_['vol_tra'] = numpy.mean([g['vol_tra'] for g in geometries], 0)
+        geom_ = flexData.copy_geometry(geom, vol_tra = numpy.mean([g['vol_tra'] for g in geometries], 0))
         geometries_.append(geom_)
 
     print('Em Emm Emmmm...')
     
     flexUtil.progress_bar(0)
         
-    for ii in range(iterations):
+    # Projectors are created once for all iterations:
+    contexts = [ProjectionContext(volume, geom, proj.shape, cache = options.get('cache')) for geom, proj in zip(geometries_, projections)]
+    
+    try:
+        for ii in range(iterations):
         
-        #l2_ = 0
-        for ii, proj in enumerate(projections):
+            #l2_ = 0
+            for jj, proj in enumerate(projections):
             
-            geom = geometries_[ii]
+                geom = geometries_[jj]
 
-            # Update volume:
-            l2_ = _em_step_(proj, 1, volume, geom, options)
+                # Update volume:
+                l2_ = _em_step_(proj, 1, volume, geom, options, context = contexts[jj])
             
-        # Preview
-        if options.get('preview'):
-            flexUtil.display_slice(volume, dim = 0)
+            # Preview
+            if options.get('preview'):
+                flexUtil.display_slice(volume, dim = 0)
             
-        l2.append(l2_)
+            l2.append(l2_)
             
-        flexUtil.progress_bar((ii+1) / iterations)
+            flexUtil.progress_bar((ii+1) / iterations)
+            
+    finally:
+        for context in contexts: context.close()
         
     if options.get('l2_update'):   
 
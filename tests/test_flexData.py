@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of flexData. Run with: python -m pytest tests
+"""
+
+''' * Imports * '''
+
+import numpy
+
+from flexbox import flexData
+
+''' * Tests * '''
+
+def test_cast2type_auto_bounds_2d():
+    """
+    Quantile bounds of a single image (2D data).
+    """
+    image = numpy.linspace(0, 100, 50 * 60, dtype = 'float32').reshape(50, 60)
+
+    bounds = flexData._bounds_(image, quantiles = [0.001, 0.999])
+    assert 0 <= bounds[0] < 1 and 99 < bounds[1] <= 100
+
+    result = flexData.cast2type(image, 'uint8', bounds = 'auto')
+
+    assert result.shape == image.shape
+    assert result.dtype == numpy.uint8
+    assert result[0, 0] == 0 and result[-1, -1] == 255
+
+def test_scaled_array_constant_bounds():
+    """
+    Assignment to a ScaledArray with equal bounds (constant data).
+    """
+    array = flexData.ScaledArray(numpy.zeros([4, 5], dtype = 'uint16'), [3, 3])
+
+    with numpy.errstate(divide = 'raise', invalid = 'raise'):
+        array[...] = numpy.full([4, 5], 3, dtype = 'float32')
+
+    assert numpy.all(array[...] == 3)
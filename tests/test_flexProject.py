@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of flexProject. Run with: python -m pytest tests
+"""
+
+''' * Imports * '''
+
+import numpy
+
+from flexbox import flexData
+from flexbox import flexModel
+from flexbox import flexProject
+
+''' * Tests * '''
+
+def _em_(projections, geometry, block_number):
+    """
+    EM reconstruction of the test phantom.
+    """
+    volume = numpy.ones([24, 24, 24], dtype = 'float32')
+    options = {'bounds':None, 'block_number':block_number, 'index':'sequential', 'l2_update': False}
+
+    flexProject.EM(projections.copy(), volume, geometry, 10, options = options)
+
+    return volume
+
+def test_em_blocks_match():
+    """
+    EM split into blocks converges to the same volume as EM with a single block.
+    """
+    flexProject.set_backend('cpu')
+
+    geometry = flexData.create_geometry(100, 100, 0.2, [0, 360])
+
+    phantom = flexModel.phantom([24, 24, 24], 'ball', [8, 1]) * 0.5
+    projections = numpy.zeros([24, 37, 32], dtype = 'float32')
+    flexProject.forwardproject(projections, phantom, geometry)
+
+    single = _em_(projections, geometry, 1)
+    blocked = _em_(projections, geometry, 3)
+
+    # Inside of the ball is reconstructed in both cases:
+    inner = phantom > 0
+    assert abs(single[inner].mean() - 0.5) < 0.1
+    assert abs(blocked[inner].mean() - 0.5) < 0.1
+
+    assert numpy.abs(blocked - single).mean() < 0.05 * single[inner].mean()